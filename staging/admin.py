@@ -1,3 +1,59 @@
+import os
+
 from django.contrib import admin
 
-# Register your models here.
+from staging.models import Environment, AllowedRepository, DatabaseTemplate, DatabaseMaintenance, StageRun, \
+    Snapshot, WebhookDelivery
+
+
+class StageRunInline(admin.TabularInline):
+    model = StageRun
+    fields = ('operation', 'stage', 'started', 'duration', 'exit_code', 'output_size')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(Environment)
+class EnvironmentAdmin(admin.ModelAdmin):
+    list_display = ('name', 'repository', 'branch', 'short_sha', 'status', 'updated')
+    list_filter = ('status', 'repository')
+    search_fields = ('name', 'branch', 'sha')
+    inlines = [StageRunInline]
+
+    def save_model(self, request, obj, form, change):
+        super(EnvironmentAdmin, self).save_model(request, obj, form, change)
+        if {'uwsgi_processes', 'uwsgi_threads'} & set(form.changed_data) and os.path.isdir(obj._get_nginx_root()):
+            obj.vassal_configure()
+
+
+@admin.register(StageRun)
+class StageRunAdmin(admin.ModelAdmin):
+    list_display = ('environment_name', 'operation', 'stage', 'started', 'duration', 'exit_code', 'output_size')
+    list_filter = ('operation', 'stage')
+    search_fields = ('environment_name', 'run')
+
+    def changelist_view(self, request, extra_context=None):
+        extra_context = dict(extra_context or {}, statistics=StageRun.statistics())
+        return super(StageRunAdmin, self).changelist_view(request, extra_context=extra_context)
+
+
+admin.site.register(AllowedRepository)
+admin.site.register(DatabaseTemplate)
+admin.site.register(DatabaseMaintenance)
+
+
+@admin.register(Snapshot)
+class SnapshotAdmin(admin.ModelAdmin):
+    list_display = ('name', 'environment', 'status', 'automatic', 'size', 'created')
+    list_filter = ('status', 'automatic')
+    readonly_fields = ('database',)
+
+
+@admin.register(WebhookDelivery)
+class WebhookDeliveryAdmin(admin.ModelAdmin):
+    list_display = ('delivery', 'event', 'received', 'processed', 'attempts', 'result')
+    list_filter = ('event',)
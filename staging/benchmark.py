@@ -0,0 +1,419 @@
+"""
+Benchmark of the provisioning pipeline and of the web hook, which runs offline: in a sandbox
+directory, against stubs of git, psql, pg_restore, virtualenv, pip, the manage.py commands and
+sudo, which take a configurable time, and a fake GitHub API receiving the commit statuses.
+Neither network, PostgreSQL nor Redis are needed, the database of wonderbot itself is SQLite.
+
+    python -m staging.benchmark --concurrency 8 --latency pg_restore=5 --latency pip=2
+
+Reports the duration of each stage, of each operation from end to end, the throughput of
+concurrent operations and the requests per second of the web hook.
+"""
+import argparse
+import contextlib
+import hashlib
+import hmac
+import http.server
+import json
+import os
+import shutil
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Seconds taken by each stubbed command, the manage.py commands by their name
+LATENCIES = {
+    "git clone": 1.0,
+    "git fetch": 0.3,
+    "git worktree": 0.2,
+    "git checkout": 0.1,
+    "git": 0.01,
+    "psql": 0.05,
+    "pg_restore": 2.0,
+    "virtualenv": 0.5,
+    "pip": 2.0,
+    "migrate": 1.0,
+    "collectstatic": 0.5,  # listing the static files
+    "sudo": 0.5,
+    "github": 0.1,
+}
+
+# Changes between two commits, as listed by `git diff --name-status`
+DIFF = "M\tanagrafica/views.py\n" \
+       "A\tanagrafica/migrations/0042_benchmark.py\n"
+
+SECRET = "benchmark"
+
+STUB = r'''#!%(python)s
+# Stub of %(commands)s for the benchmark, see staging/benchmark.py
+import json
+import os
+import sys
+import time
+
+config = json.load(open(os.environ["WONDERBOT_BENCHMARK_CONFIG"]))
+name, args = os.path.basename(sys.argv[0]), sys.argv[1:]
+
+
+def sleep(key):
+    time.sleep(config["latencies"].get(key, 0))
+
+
+if name == "git":
+    args = [arg for arg in args if not arg.startswith("--git-dir=")]
+    command, sub = args[0], (args[1:] or [""])[0]
+    if command == "clone":
+        sleep("git clone")
+        os.makedirs(args[-1], exist_ok=True)
+    elif command == "remote":
+        sleep("git fetch")
+    elif command == "rev-parse":
+        sleep("git")
+        print(open(config["head"]).read().strip())
+    elif command == "diff":
+        sleep("git")
+        sys.stdout.write(config["diff"])
+    elif command == "worktree" and sub == "add":
+        sleep("git worktree")
+        os.makedirs(args[-2])
+        with open("%%s/requirements.txt" %% (args[-2],), "w") as f:
+            f.write(config["requirements"])
+    elif command == "worktree" and sub == "move":
+        sleep("git worktree")
+        os.rename(args[2], args[3])
+    elif command == "checkout":
+        sleep("git checkout")
+    else:
+        sleep("git")
+
+elif name == "psql":
+    sys.stdin.read()
+    sleep("psql")
+    if "-t" in args:
+        # Queries, e.g. the size of a database
+        print(config["database_size"])
+
+elif name == "python3":
+    if args[:2] == ["-m", "virtualenv"]:
+        sleep("virtualenv")
+        os.makedirs("%%s/bin" %% (args[-1],))
+        for tool in ("python", "pip"):
+            os.symlink(os.path.realpath(__file__), "%%s/bin/%%s" %% (args[-1], tool))
+    else:
+        print(config["python_version"])
+
+elif name == "python" and args[0] == "-c":
+    # Listing of the static files of an environment, see staging.statics
+    sleep("collectstatic")
+    sources = {}
+    for i in range(config["static_files"]):
+        source = os.path.abspath("assets/benchmark/%%d/%%d.css" %% (i %% 10, i))
+        if not os.path.exists(source):
+            os.makedirs(os.path.dirname(source), exist_ok=True)
+            with open(source, "w") as f:
+                f.write("/* %%d */\n" %% (i,))
+        sources["benchmark/%%d/%%d.css" %% (i %% 10, i)] = source
+    print(json.dumps(sources))
+
+elif name == "python":
+    # manage.py in the virtualenv of an environment
+    sleep(args[1])
+
+else:
+    sleep(name)
+'''
+
+STUBBED = ("git", "psql", "pg_restore", "python3", "pip", "sudo")
+
+
+def sandbox_create(root, latencies, static_files, github_url):
+    """
+    Lays out a sandbox in `root`, and returns the environment variables pointing
+    wonderbot to it (see STAGING_ROOT in wonderbot/settings.py).
+    """
+    staging, home, bin = ("%s/%s" % (root, name) for name in ("staging", "home", "bin"))
+    for directory in ("%s/skeleton/config" % (staging,), "%s/run" % (staging,), home, bin):
+        os.makedirs(directory)
+    for filename, contents in (("%s/.github_token" % (home,), "benchmark\n"),
+                               ("%s/.github_webhook_secret" % (home,), "%s\n" % (SECRET,)),
+                               ("%s/dump" % (staging,), "dump\n"),
+                               ("%s/head" % (root,), "%s\n" % (_sha(),))):
+        with open(filename, "w") as f:
+            f.write(contents)
+
+    config = {"latencies": latencies, "head": "%s/head" % (root,), "diff": DIFF,
+              "requirements": "Django==1.11.1\n", "python_version": "3.5.3 (benchmark)",
+              "database_size": 512 * 1024 ** 2, "static_files": static_files}
+    with open("%s/benchmark.json" % (root,), "w") as f:
+        json.dump(config, f)
+    with open("%s/stub" % (bin,), "w") as f:
+        f.write(STUB % {"python": sys.executable, "commands": ", ".join(STUBBED)})
+    os.chmod("%s/stub" % (bin,), 0o755)
+    for command in STUBBED:
+        os.symlink("%s/stub" % (bin,), "%s/%s" % (bin, command))
+
+    return {"WONDERBOT_STAGING_ROOT": staging, "WONDERBOT_STAGING_HOME": home,
+            "WONDERBOT_GITHUB_API_URL": github_url, "WONDERBOT_SUDO_BIN": "%s/sudo" % (bin,),
+            # Nothing listens there: dashboard notifications and log buffers are skipped
+            "WONDERBOT_REDIS_URL": "redis://127.0.0.1:1",
+            "WONDERBOT_BENCHMARK_CONFIG": "%s/benchmark.json" % (root,),
+            "PATH": "%s:%s" % (bin, os.environ.get("PATH", ""))}
+
+
+def _sha():
+    return hashlib.sha1(uuid.uuid4().bytes).hexdigest()
+
+
+class FakeGitHub(object):
+    """
+    Receives the commit statuses, as the GitHub API would after `latency` seconds.
+    """
+
+    def __init__(self, latency):
+        benchmark = self
+        self.statuses = 0
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                time.sleep(latency)
+                benchmark.statuses += 1
+                self.send_response(201)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(b"{}")
+
+            def log_message(self, *args):
+                pass
+
+        self.server = _ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%d" % (self.server.server_port,)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class Timings(object):
+    """
+    Durations of the operations, by name.
+    """
+
+    def __init__(self):
+        self.durations = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def timing(self, name):
+        started = time.time()
+        yield
+        with self.lock:
+            self.durations.setdefault(name, []).append(time.time() - started)
+
+
+def _setup(root):
+    import django
+    from django.conf import settings
+    settings.DATABASES["default"].update(NAME="%s/wonderbot.sqlite3" % (root,), OPTIONS={"timeout": 60})
+    # Queued tasks stay in memory, no worker runs them
+    settings.CELERY_BROKER_URL = "memory://"
+    settings.CELERY_RESULT_BACKEND = "cache+memory://"
+    django.setup()
+    from django.core.management import call_command
+    from django.test.utils import setup_test_environment
+    call_command("migrate", verbosity=0)
+    # The hook is called through the test client
+    setup_test_environment()
+
+
+def _next_head(root):
+    sha = _sha()
+    with open("%s/head" % (root,), "w") as f:
+        f.write("%s\n" % (sha,))
+    return sha
+
+
+def benchmark_lifecycle(root, runs, timings):
+    """
+    Creates environments one at a time, then updates each of them incrementally and fully,
+    and deletes them.
+    """
+    from staging.models import Environment
+    for i in range(runs):
+        head = open("%s/head" % (root,)).read().strip()
+        environment = Environment(name="bench-%d" % (i,), sha=head)
+        environment.save()
+        with timings.timing("creation"):
+            environment.do_creation()
+
+        environment.sha = _next_head(root)
+        environment.save()
+        with timings.timing("incremental update"):
+            environment.do_update(full=False)
+
+        _next_head(root)
+        with timings.timing("update"):
+            environment.do_update()
+
+        with timings.timing("deletion"):
+            environment.do_delete()
+
+
+def benchmark_concurrency(root, concurrency, timings):
+    """
+    Creates `concurrency` environments at the same time, then deletes them at the same time.
+    Returns the number of operations per minute of each.
+    """
+    from staging.models import Environment
+    head = open("%s/head" % (root,)).read().strip()
+    environments = [Environment(name="bench-c%d" % (i,), sha=head) for i in range(concurrency)]
+    for environment in environments:
+        environment.save()
+
+    throughput = {}
+    for operation, run in (("concurrent creation", lambda e: e.do_creation()),
+                           ("concurrent deletion", lambda e: e.do_delete())):
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for environment in environments:
+                executor.submit(_timed, timings, operation, run, environment)
+        throughput[operation] = concurrency * 60 / (time.time() - started)
+    return throughput
+
+
+def _timed(timings, name, function, *args):
+    from django.db import connection
+    try:
+        with timings.timing(name):
+            function(*args)
+    finally:
+        connection.close()
+
+
+def benchmark_hook(requests, timings):
+    """
+    Sends `requests` signed push deliveries to the hook, each of them twice, as GitHub
+    redelivering. Returns the requests per second, and the number of each response status.
+    """
+    from django.test import Client
+    client = Client()
+    # Not timed: loads the URLs and views
+    client.get("/hook/")
+    statuses = {}
+    started = time.time()
+    for i in range(requests):
+        body = json.dumps({"ref": "refs/heads/benchmark-%d" % (i,), "after": _sha(),
+                           "repository": {"ssh_url": "git@github.com:CroceRossaItaliana/jorvik.git"}})
+        body = body.encode("utf-8")
+        signature = "sha256=%s" % (hmac.new(SECRET.encode("utf-8"), body, hashlib.sha256).hexdigest(),)
+        delivery = str(uuid.uuid4())
+        for name in ("hook", "hook (redelivery)"):
+            with timings.timing(name):
+                response = client.post("/hook/", body, content_type="application/json",
+                                       HTTP_X_GITHUB_EVENT="push", HTTP_X_GITHUB_DELIVERY=delivery,
+                                       HTTP_X_HUB_SIGNATURE_256=signature)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+    return 2 * requests / (time.time() - started), statuses
+
+
+def report(timings, throughput, hook_rate, hook_statuses, github, wall):
+    from staging.models import StageRun
+    from staging.utils import percentile
+
+    def row(name, durations, unit=1, suffix="s"):
+        print("%-46s %5d %9.3f%s %9.3f%s %9.3f%s" % (
+            name, len(durations), percentile(durations, 50) * unit, suffix,
+            percentile(durations, 95) * unit, suffix, max(durations) * unit, suffix))
+
+    header = "%-46s %5s %10s %10s %10s" % ("", "runs", "p50", "p95", "max")
+    print("\nStages")
+    print(header)
+    runs = StageRun.objects.filter(duration__isnull=False).values_list('operation', 'stage', 'duration')
+    stages = {}
+    for operation, stage, duration in runs:
+        stages.setdefault("%s: %s" % (operation, stage), []).append(duration)
+    for name in sorted(stages):
+        row(name, stages[name])
+
+    print("\nOperations, end to end")
+    print(header)
+    for name in sorted(n for n in timings.durations if not n.startswith("hook")):
+        row(name, timings.durations[name])
+
+    print("\nConcurrent operations")
+    for name, rate in sorted(throughput.items()):
+        print("%-46s %9.1f per minute" % (name, rate))
+
+    print("\nWeb hook")
+    print(header)
+    for name in sorted(n for n in timings.durations if n.startswith("hook")):
+        row(name, timings.durations[name], unit=1000, suffix="ms")
+    print("%-46s %9.1f" % ("requests per second", hook_rate))
+    print("%-46s %s" % ("responses", ", ".join("%d: %d" % s for s in sorted(hook_statuses.items()))))
+
+    print("\n%-46s %9d" % ("commit statuses sent to GitHub", github.statuses))
+    print("%-46s %9.1fs" % ("total", wall))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks wonderbot offline, against stubbed commands.")
+    parser.add_argument("--runs", type=int, default=3,
+                        help="environments created, updated and deleted one at a time")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="environments created and deleted at the same time")
+    parser.add_argument("--hooks", type=int, default=200, help="deliveries sent to the web hook")
+    parser.add_argument("--static-files", type=int, default=200, help="static files of each environment")
+    parser.add_argument("--latency", action="append", default=[], metavar="COMMAND=SECONDS",
+                        help="time taken by a stubbed command, one of: %s" % (", ".join(sorted(LATENCIES)),))
+    parser.add_argument("--keep", action="store_true", help="keep the sandbox, with the logs of the runs")
+    args = parser.parse_args(argv)
+
+    latencies = dict(LATENCIES)
+    for latency in args.latency:
+        command, _, seconds = latency.partition("=")
+        if command not in LATENCIES:
+            parser.error("unknown command %s" % (command,))
+        latencies[command] = float(seconds)
+
+    root = tempfile.mkdtemp(prefix="wonderbot-benchmark-")
+    github = FakeGitHub(latencies["github"])
+    # Read by wonderbot/settings.py, so set before Django is set up
+    os.environ.update(sandbox_create(root, latencies, args.static_files, github.url))
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "wonderbot.settings")
+    print("# Sandbox in %s" % (root,))
+
+    timings, started = Timings(), time.time()
+    try:
+        # What wonderbot prints goes to the log, only the report to the terminal
+        with open("%s/benchmark.log" % (root,), "w") as log, contextlib.redirect_stdout(log):
+            _setup(root)
+            from staging.github import reporter
+            from staging.models import DatabaseTemplate
+            from wonderbot.settings import DB_TEMPLATE_ENABLED
+            if DB_TEMPLATE_ENABLED:
+                with timings.timing("template build"):
+                    DatabaseTemplate.build_if_outdated()
+            benchmark_lifecycle(root, args.runs, timings)
+            throughput = benchmark_concurrency(root, args.concurrency, timings)
+            hook_rate, hook_statuses = benchmark_hook(args.hooks, timings)
+            reporter.flush(timeout=60)
+        report(timings, throughput, hook_rate, hook_statuses, github, time.time() - started)
+    finally:
+        github.stop()
+        if args.keep:
+            print("# Sandbox kept in %s" % (root,))
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import re
+
+MIGRATION = re.compile(r"(^|/)migrations/(?!__init__\.py$)[^/]+\.py$")
+STATIC = re.compile(r"(^|/)static/")
+
+
+class Changes(object):
+    """
+    What a range of commits touches, as far as provisioning is concerned.
+    Built from the output of `git diff --name-status`.
+    """
+
+    def __init__(self, diff):
+        self.files = []
+        for line in diff.splitlines():
+            fields = line.split("\t")
+            if len(fields) < 2:
+                continue
+            # Renames and copies list both the old and the new path
+            self.files += [(fields[0][0], path) for path in fields[1:]]
+
+    def _matching(self, expression, statuses=None):
+        return [path for status, path in self.files
+                if expression.search(path) and (statuses is None or status in statuses)]
+
+    @property
+    def requirements(self):
+        return any(path == "requirements.txt" for _, path in self.files)
+
+    @property
+    def static(self):
+        return bool(self._matching(STATIC))
+
+    @property
+    def migrations_added(self):
+        return bool(self._matching(MIGRATION, statuses="A"))
+
+    @property
+    def migrations_rewritten(self):
+        """
+        Migrations which were modified, removed or renamed: the existing database can't be kept.
+        """
+        return bool(self._matching(MIGRATION, statuses="MDRCT"))
+
+    def __str__(self):
+        return "%d files (requirements: %s, static: %s, new migrations: %s, rewritten migrations: %s)" % (
+            len(self.files), self.requirements, self.static, self.migrations_added, self.migrations_rewritten)
@@ -1,39 +1,281 @@
+import collections
+import contextlib
+import os
+import shlex
+import signal
 import subprocess
 import sys
+import threading
+import time
 
+from staging.utils import file_semaphore
+from wonderbot.settings import COMMAND_TIMEOUT, COMMAND_TIMEOUTS, COMMAND_LIMITS, COMMAND_LIMITS_PATH, \
+    COMMAND_KILL_GRACE, COMMAND_POLL_INTERVAL, COMMAND_ERROR_LINES
 
-def bash_execute(command, stdout=None, stderr=None, cwd=None, venv=None):
 
+_recording = threading.local()
+
+
+class Recording(object):
+    """
+    Exit code and output size of the commands run within a recording() block.
+    """
+
+    def __init__(self):
+        self.commands = 0
+        self.exit_code = 0
+        self.output_size = 0
+
+    def record(self, exit_code, output_size):
+        self.commands += 1
+        self.output_size += output_size
+        if exit_code:
+            self.exit_code = exit_code
+
+
+@contextlib.contextmanager
+def recording():
+    """
+    Records the commands executed by the current thread within the block.
+    """
+    previous = getattr(_recording, "current", None)
+    _recording.current = Recording()
+    try:
+        yield _recording.current
+    finally:
+        _recording.current = previous
+
+
+def _record(exit_code, output_size):
+    current = getattr(_recording, "current", None)
+    if current:
+        current.record(exit_code, output_size)
+
+
+@contextlib.contextmanager
+def logging_to(log, prefix=""):
+    """
+    Sends the output of the commands executed by the current thread within the block
+    to `log` (see staging.logs.RunLog) instead of the standard output, each line
+    starting with `prefix`.
+    """
+    previous = getattr(_recording, "log", None)
+    _recording.log = (log, prefix)
+    try:
+        yield log
+    finally:
+        _recording.log = previous
+
+
+def _output(text, log=None):
+    if not log:
+        sys.stdout.write(text)
+        sys.stdout.flush()
+        return
+    log, prefix = log
+    for line in text.splitlines(True):
+        log.write("%s%s" % (prefix, line if line.endswith("\n") else line + "\n"))
+
+
+def log(message):
+    """
+    Writes a line to the log of the current thread (see logging_to), or to the standard output.
+    """
+    _output("# %s\n" % (message,), getattr(_recording, "log", None))
+
+
+@contextlib.contextmanager
+def cancellable(cancelled):
+    """
+    Kills the commands executed by the current thread within the block as soon
+    as `cancelled()` becomes true, raising CommandCancelled.
+    """
+    previous = getattr(_recording, "cancelled", None)
+    _recording.cancelled = cancelled
+    try:
+        yield
+    finally:
+        _recording.cancelled = previous
+
+
+class CommandError(Exception):
+    """
+    Raised when a command fails. Carries the command, its exit code and the end of its output.
+    """
+
+    def __init__(self, argv, returncode, output=""):
+        self.argv = argv
+        self.returncode = returncode
+        self.output = output
+        super(CommandError, self).__init__("%s %s%s" % (
+            " ".join(shlex.quote(arg) for arg in argv), self._reason(),
+            ("\n%s" % output.rstrip()) if output.strip() else ""))
+
+    def _reason(self):
+        return "exited with code %s" % (self.returncode,)
+
+
+class CommandTimeout(CommandError):
+
+    def _reason(self):
+        return "timed out"
+
+
+class CommandCancelled(CommandError):
+
+    def _reason(self):
+        return "was cancelled"
+
+
+class Result(object):
+    """
+    Outcome of a command. The output is only available if it was captured.
+    """
+
+    def __init__(self, argv, returncode, out="", err=""):
+        self.argv = argv
+        self.returncode = returncode
+        self.out = out
+        self.err = err
+
+
+@contextlib.contextmanager
+def _concurrency_limit(kind, cancelled):
+    slots = COMMAND_LIMITS.get(kind)
+    if not slots:
+        yield
+        return
+
+    def waiting():
+        if cancelled and cancelled():
+            raise CommandCancelled([kind], None, "while waiting for a slot")
+
+    os.makedirs(COMMAND_LIMITS_PATH, exist_ok=True)
+    with file_semaphore("%s/%s" % (COMMAND_LIMITS_PATH, kind), slots, waiting=waiting):
+        yield
+
+
+def _kill(p):
+    """
+    Terminates a command and everything it started, i.e. its whole process group.
+    """
+    for sig, grace in ((signal.SIGTERM, COMMAND_KILL_GRACE), (signal.SIGKILL, None)):
+        try:
+            os.killpg(p.pid, sig)
+        except ProcessLookupError:
+            return
+        try:
+            p.wait(timeout=grace)
+            return
+        except subprocess.TimeoutExpired:
+            continue
+
+
+def execute(argv, cwd=None, venv=None, env=None, input=None, kind=None, timeout=None,
+            check=True, capture=False):
+    """
+    Runs a command, given as a list of arguments. Its output goes to the log of the current
+    thread (see logging_to), unless captured.
+
+    :param venv: Path of a virtualenv to run the command in, relative to `cwd`.
+    :param env: Variables to add to the environment of the command.
+    :param input: Text fed to the standard input of the command.
+    :param kind: Name of the kind of command (e.g. "pip"), setting how many of them can run at
+                 the same time across all worker processes (COMMAND_LIMITS) and their default
+                 timeout (COMMAND_TIMEOUTS).
+    :param timeout: Seconds after which the command is killed, and CommandTimeout raised.
+    :param check: Raise CommandError if the command exits with a non-zero code.
+    :param capture: Return the standard output and error in the result instead of logging them.
+    :return: A Result.
+    """
+    argv = [str(arg) for arg in argv]
+    environ = dict(os.environ, **(env or {}))
     if venv:
-        command = ". %s/bin/activate && %s" % (venv, command)
-    if cwd:
-        command = "cd %s && %s" % (cwd, command)
-    #stdout = stdout or sys.stdout
-    #stderr = stderr or sys.stderr
+        venv = os.path.join(cwd or "", venv)
+        environ["VIRTUAL_ENV"] = venv
+        environ["PATH"] = "%s/bin:%s" % (venv, environ.get("PATH", ""))
+    if timeout is None:
+        timeout = COMMAND_TIMEOUTS.get(kind, COMMAND_TIMEOUT)
+    cancelled = getattr(_recording, "cancelled", None)
+    log = getattr(_recording, "log", None)
+
+    _output("$ %s%s\n" % ("cd %s && " % (cwd,) if cwd else "", " ".join(shlex.quote(arg) for arg in argv)), log)
+    with _concurrency_limit(kind, cancelled):
+        p = subprocess.Popen(argv, cwd=cwd, env=environ, start_new_session=True,
+                             stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE if capture else subprocess.STDOUT)
+        streams = {"out": [], "err": []}
+        tail = collections.deque(maxlen=COMMAND_ERROR_LINES)
+        size = [0]
+
+        def read(stream, name):
+            for line in stream:
+                size[0] += len(line)
+                line = line.decode("utf-8", "replace")
+                tail.append(line)
+                if capture:
+                    streams[name].append(line)
+                else:
+                    _output(line, log)
+            stream.close()
+
+        def write():
+            try:
+                p.stdin.write(input.encode("utf-8"))
+                p.stdin.close()
+            except BrokenPipeError:
+                pass
+
+        threads = [threading.Thread(target=read, args=(p.stdout, "out"))]
+        if capture:
+            threads.append(threading.Thread(target=read, args=(p.stderr, "err")))
+        if input is not None:
+            threads.append(threading.Thread(target=write))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        error = None
+        deadline = time.time() + timeout if timeout else None
+        while error is None:
+            try:
+                p.wait(timeout=COMMAND_POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                if deadline and time.time() > deadline:
+                    error = CommandTimeout
+                elif cancelled and cancelled():
+                    error = CommandCancelled
+        if error:
+            _kill(p)
+        for thread in threads:
+            thread.join()
 
-    print("$ %s" % command)
-    c = subprocess.call(command, shell=True,
-                        stdout=stdout, stderr=stderr)
-    return c
+    _record(p.returncode if error is None else -1, size[0])
+    if error:
+        _output("# %s\n" % ("Timed out after %ds" % (timeout,) if error is CommandTimeout else "Cancelled"), log)
+        raise error(argv, p.returncode, "".join(tail))
+    if p.returncode and capture:
+        _output("".join(streams["err"]), log)
+    if p.returncode and check:
+        raise CommandError(argv, p.returncode, "".join(tail))
+    return Result(argv, p.returncode, "".join(streams["out"]), "".join(streams["err"]))
 
 
 def file_delete(filename, **kwargs):
-    command = "rm %s" % filename
-    return bash_execute(command, **kwargs)
+    return execute(["rm", "-f", filename], **kwargs)
 
 
 def file_write(filename, contents, mode="wt"):
+    # The contents are not logged, configuration files contain passwords
     with open(filename, mode=mode) as f:
-        print("~ %s" % filename)
-        print(contents)
+        _output("~ %s (%d characters)\n" % (filename, len(contents)), getattr(_recording, "log", None))
         return f.write(contents)
 
 
 def dir_delete(path, **kwargs):
-    command = "rm -rf %s" % path
-    return bash_execute(command, **kwargs)
+    return execute(["rm", "-rf", path], **kwargs)
 
 
 def dir_create(path, **kwargs):
-    command = "mkdir %s" % path
-    return bash_execute(command, **kwargs)
+    return execute(["mkdir", "-p", path], **kwargs)
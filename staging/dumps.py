@@ -0,0 +1,171 @@
+import contextlib
+import fcntl
+import gzip
+import os
+import shutil
+
+import staging.cmd as cmd
+from staging.postgres import postgres_batch, postgres_restore, sql_terminate_connections
+from staging.scheduler import restore_workers
+from wonderbot.settings import DB_BACKUP_PATH, DB_DUMPS_PATH, DB_DUMPS_KEPT, DB_DUMP_FILENAME, \
+    DB_DUMP_DIRECTORY_FORMAT
+
+SOURCE_FILE = "source"
+LOCK_FILE = ".lock"
+
+
+def dump_generations():
+    """
+    The generations of ingested dumps, oldest first.
+    """
+    if not os.path.isdir(DB_DUMPS_PATH):
+        return []
+    return sorted(int(name) for name in os.listdir(DB_DUMPS_PATH) if name.isdigit())
+
+
+def dump_generation_path(generation):
+    return "%s/%d" % (DB_DUMPS_PATH, generation)
+
+
+def dump_current_generation():
+    """
+    The generation DB_DUMP_FILENAME points to, or None if it is not an ingested dump.
+    """
+    if not os.path.islink(DB_DUMP_FILENAME):
+        return None
+    name = os.path.basename(os.path.dirname(os.readlink(DB_DUMP_FILENAME)))
+    return int(name) if name.isdigit() else None
+
+
+@contextlib.contextmanager
+def dump_reading(filename=DB_DUMP_FILENAME):
+    """
+    Resolves a dump to the file or directory of its generation, and yields that path. The
+    generation is not deleted until the block exits, even if a newer dump is ingested meanwhile.
+    """
+    path = os.path.realpath(filename)
+    lock = os.path.join(os.path.dirname(path), LOCK_FILE)
+    if not os.path.exists(lock):
+        # Not an ingested dump
+        yield path
+        return
+    with open(lock) as f:
+        fcntl.flock(f, fcntl.LOCK_SH)
+        try:
+            yield path
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def backup_latest():
+    """
+    The most recent production backup, or None.
+    """
+    if not os.path.isdir(DB_BACKUP_PATH):
+        return None
+    paths = [os.path.join(DB_BACKUP_PATH, name) for name in os.listdir(DB_BACKUP_PATH)]
+    paths = [path for path in paths if os.path.isfile(path)]
+    return max(paths, key=os.path.getmtime) if paths else None
+
+
+def backup_signature(path):
+    stat = os.stat(path)
+    return "%s %d %d" % (path, stat.st_mtime, stat.st_size)
+
+
+def dump_ingest(backup=None, directory_format=DB_DUMP_DIRECTORY_FORMAT):
+    """
+    Ingests a production backup (by default the latest one, gzipped or not) as a new
+    generation of the dump, unless it already was. The backup is decompressed while
+    being read and, optionally, converted to the directory format, which pg_restore can
+    restore in parallel, table by table. Only once the new generation is complete does
+    DB_DUMP_FILENAME point to it. Returns the new generation, or None.
+    """
+    backup = backup or backup_latest()
+    if not backup:
+        print("# No backup found in %s." % (DB_BACKUP_PATH,))
+        return None
+    current = dump_current_generation()
+    if current is not None and _read(dump_generation_path(current), SOURCE_FILE) == backup_signature(backup):
+        print("# Backup %s already ingested." % (backup,))
+        return None
+
+    generation = max(dump_generations() + [0]) + 1
+    path = dump_generation_path(generation)
+    building = "%s.tmp" % (path,)
+    cmd.dir_delete(building)
+    os.makedirs(building)
+    try:
+        dump = _decompress(backup, "%s/dump" % (building,))
+        if directory_format:
+            dump = _convert_to_directory(dump, "%s/dump.d" % (building,), generation)
+        cmd.file_write("%s/%s" % (building, SOURCE_FILE), backup_signature(backup))
+        cmd.file_write("%s/%s" % (building, LOCK_FILE), "")
+    except:
+        cmd.dir_delete(building)
+        raise
+    os.rename(building, path)
+
+    # Atomic swap: restores read either the previous generation, or this one
+    link = "%s.new" % (DB_DUMP_FILENAME,)
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.join(path, os.path.basename(dump)), link)
+    os.replace(link, DB_DUMP_FILENAME)
+    print("# Dump generation %d ingested from %s." % (generation, backup))
+
+    dump_prune()
+    return generation
+
+
+def dump_prune(keep=DB_DUMPS_KEPT):
+    """
+    Deletes the old generations, except the last `keep` ones and those still being read.
+    """
+    current = dump_current_generation()
+    for generation in dump_generations()[:-keep or None]:
+        if generation == current:
+            continue
+        path = dump_generation_path(generation)
+        with open("%s/%s" % (path, LOCK_FILE), "a") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            cmd.dir_delete(path)
+
+
+def _read(path, name):
+    try:
+        with open(os.path.join(path, name)) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _decompress(backup, target):
+    with open(backup, "rb") as f:
+        compressed = f.read(2) == b"\x1f\x8b"
+    opener = gzip.open if compressed else open
+    with opener(backup, "rb") as source, open(target, "wb") as destination:
+        shutil.copyfileobj(source, destination, 1024 ** 2)
+    return target
+
+
+def _convert_to_directory(dump, target, generation):
+    """
+    Restores a custom-format dump into a scratch database, and dumps it again in the
+    directory format, using several jobs both ways. Deletes the original dump.
+    """
+    database = "staging_ingest_%d" % (generation,)
+    postgres_batch(["DROP DATABASE IF EXISTS %s;" % (database,),
+                    "CREATE DATABASE %s OWNER staging;" % (database,)], transaction=False)
+    try:
+        postgres_restore(database, filename=dump)
+        cmd.execute(["pg_dump", "-Fd", "-j", restore_workers(), "-U", "staging", "-f", target, database],
+                    kind="pg_restore")
+    finally:
+        postgres_batch(sql_terminate_connections(database), transaction=False, check=False)
+        postgres_batch(["DROP DATABASE IF EXISTS %s;" % (database,)], transaction=False, check=False)
+    cmd.file_delete(dump)
+    return target
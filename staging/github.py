@@ -1,37 +1,146 @@
-from wonderbot.settings import DEFAULT_REPOSITORY, HOME_URL, GITHUB_TOKEN_FILE
+from wonderbot.settings import DEFAULT_REPOSITORY, HOME_URL, GITHUB_TOKEN_FILE, GITHUB_API_URL, \
+    GITHUB_STATUS_CONTEXT, GITHUB_STATUS_TIMEOUT, GITHUB_STATUS_RETRIES, GITHUB_STATUS_BACKOFF
 
+import atexit
+import collections
 import json
+import os
+import threading
+import time
+
 import requests
+from requests.adapters import HTTPAdapter
+
+_token = (None, None)
 
 
 def github_token():
     """
-    Tries to read a token from ~/.github_token and return it.
+    Tries to read a token from ~/.github_token and return it, caching it until the file changes.
     Returns None if no token is found.
     """
+    global _token
     try:
-        with open(GITHUB_TOKEN_FILE, "rt") as f:
-            return f.readline().rstrip("\n")
+        mtime = os.path.getmtime(GITHUB_TOKEN_FILE)
+        if _token[0] != mtime:
+            with open(GITHUB_TOKEN_FILE, "rt") as f:
+                _token = (mtime, f.readline().rstrip("\n"))
+        return _token[1]
     except:
         return None
 
 
+class StatusReporter(object):
+    """
+    Sends commit statuses to GitHub in the background, over a pooled HTTP session, retrying
+    with exponential backoff. Statuses not yet sent for the same sha and context are
+    collapsed into the latest one. A status waiting to be retried does not hold up the
+    others: each is sent when due, in order.
+    """
+
+    def __init__(self, api_url=GITHUB_API_URL, timeout=GITHUB_STATUS_TIMEOUT,
+                 retries=GITHUB_STATUS_RETRIES, backoff=GITHUB_STATUS_BACKOFF):
+        self.api_url = api_url.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        # (sha, context): (due time, attempt, payload)
+        self.pending = collections.OrderedDict()
+        self.sending = 0
+        self.condition = threading.Condition()
+        self.pid = None
+
+    def _start(self):
+        # Threads and connections do not survive a fork (e.g. into a Celery worker process)
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        thread = threading.Thread(target=self._run, name="github-status", daemon=True)
+        thread.start()
+
+    def send(self, sha, state, description, url, context=GITHUB_STATUS_CONTEXT):
+        assert state in ('success', 'pending', 'error', 'failure')
+        with self.condition:
+            self._start()
+            self.pending.pop((sha, context), None)
+            self.pending[(sha, context)] = (time.time(), 0, {"state": state, "description": description,
+                                                             "context": context, "target_url": url})
+            self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Waits until all statuses are sent. Returns False on timeout.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.condition:
+            while self.pending or self.sending:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def _next(self):
+        """
+        Waits for the first status due, and takes it out of the pending ones.
+        """
+        while True:
+            first = min(self.pending.items(), key=lambda item: item[1][0], default=None)
+            wait = first[1][0] - time.time() if first else None
+            if wait is not None and wait <= 0:
+                del self.pending[first[0]]
+                return first[0], first[1][1], first[1][2]
+            self.condition.wait(wait)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                key, attempt, payload = self._next()
+                self.sending += 1
+            retry = False
+            try:
+                sent = self._post(key, payload)
+                retry = not sent and attempt < self.retries
+                if not sent and not retry:
+                    print("# Giving up on %s %s." % (key[0], payload["state"]))
+            finally:
+                with self.condition:
+                    self.sending -= 1
+                    # Unless superseded by a newer status, which will be sent instead
+                    if retry and key not in self.pending:
+                        self.pending[key] = (time.time() + self.backoff * 2 ** attempt, attempt + 1, payload)
+                    self.condition.notify_all()
+
+    def _post(self, key, payload):
+        """
+        Sends a status once. Returns False if it is worth trying again.
+        """
+        sha, _ = key
+        token = github_token()
+        if not token:
+            print("# Token not found.")
+            return True
+        request_url = "%s/repos/%s/statuses/%s" % (self.api_url, DEFAULT_REPOSITORY, sha)
+        headers = {"Authorization": "token %s" % token}
+        try:
+            r = self.session.post(request_url, data=json.dumps(payload), headers=headers,
+                                  timeout=self.timeout)
+        except requests.RequestException as e:
+            print("# %s %s failed: %s" % (sha, payload["state"], e))
+            return False
+        print("# %s %s: %s" % (sha, payload["state"], r.status_code))
+        return r.status_code < 500 and r.status_code != 429
+
+
+reporter = StatusReporter()
+atexit.register(reporter.flush, GITHUB_STATUS_TIMEOUT)
+
+
 def github_commit_status(sha, state, description, url):
-    token = github_token()
-    if not token:
-        print("# Token not found.")
-        return
-
-    assert state in ('success', 'pending', 'error', 'failure')
-    request_url = "https://api.github.com/repos/%s/statuses/%s" % (DEFAULT_REPOSITORY, sha)
-    payload = json.dumps({"state": state,
-                          "description": description,
-                          "context": "wonderbot-pr",
-                          "target_url": url})
-    headers = {"Authorization": "token %s" % token,}
-    r = requests.post(request_url, data=payload, headers=headers)
-    print("# %s %s %s" % (url, headers, payload))
-    print(r)
+    reporter.send(sha, state, description, url)
 
 
 def github_pending(sha):
@@ -41,3 +150,13 @@ def github_pending(sha):
 def github_finished(environment):
     github_commit_status(environment.sha, "success",
                          "Wonderbot has created a test environment.", url=environment.url())
+
+
+def github_failed(environment, stage):
+    github_commit_status(environment.sha, "failure",
+                         "Wonderbot could not set up the environment (%s failed)." % (stage,),
+                         url="%s/environments/%d/runs/" % (HOME_URL, environment.pk))
+
+
+def github_superseded(sha, newer_sha):
+    github_commit_status(sha, "error", "Superseded by %s, not deployed." % (newer_sha[:8],), url=HOME_URL)
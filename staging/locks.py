@@ -0,0 +1,59 @@
+import contextlib
+import threading
+
+import redis
+from redis.exceptions import LockError, RedisError
+
+from wonderbot.settings import REDIS_URL, ENVIRONMENT_LOCK_TIMEOUT, ENVIRONMENT_LOCK_EXTEND_INTERVAL
+
+_redis = None
+
+
+def redis_client():
+    global _redis
+    if _redis is None:
+        _redis = redis.StrictRedis.from_url(REDIS_URL)
+    return _redis
+
+
+def environment_lock(environment_id):
+    """
+    Returns the lock guaranteeing that a single operation runs on an environment
+    at any time, across all worker processes. It expires after ENVIRONMENT_LOCK_TIMEOUT
+    in case its worker dies, unless kept (see lock_kept).
+    """
+    # Not thread local, so that it can be extended by another thread
+    return redis_client().lock("wonderbot:environment:%d" % (environment_id,),
+                               timeout=ENVIRONMENT_LOCK_TIMEOUT, thread_local=False)
+
+
+@contextlib.contextmanager
+def lock_kept(lock, interval=ENVIRONMENT_LOCK_EXTEND_INTERVAL):
+    """
+    Extends an acquired lock every `interval` seconds while the block runs, however long
+    it takes, so that the lock keeps the same time to live until then.
+    """
+    stop = threading.Event()
+
+    def keep():
+        while not stop.wait(interval):
+            try:
+                lock.extend(interval)
+            except (LockError, RedisError) as e:
+                print("# Could not extend lock %s: %s" % (lock.name, e))
+
+    thread = threading.Thread(target=keep, daemon=True)
+    thread.start()
+    try:
+        yield lock
+    finally:
+        stop.set()
+        thread.join()
+
+
+def lock_release(lock):
+    try:
+        lock.release()
+    except LockError:
+        # Expired, and possibly taken by someone else already
+        pass
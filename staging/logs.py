@@ -0,0 +1,148 @@
+import glob
+import os
+import shutil
+import threading
+
+from redis.exceptions import RedisError
+
+from staging.locks import redis_client
+from wonderbot.settings import LOGS_PATH, LOG_MAX_BYTES, LOG_BACKUPS, LOG_BUFFER_LINES, LOG_TAIL_BYTES, \
+    LOG_RUNS_KEPT
+
+
+def log_path(environment_id, run):
+    return os.path.join(LOGS_PATH, str(environment_id), "%s.log" % (run,))
+
+
+def log_buffer_key(environment_id):
+    return "wonderbot:log:%s" % (environment_id,)
+
+
+def log_latest_run(environment_id):
+    """
+    The run whose log was written last, or None.
+    """
+    paths = glob.glob(log_path(environment_id, "*"))
+    if not paths:
+        return None
+    return os.path.basename(max(paths, key=os.path.getmtime))[:-len(".log")]
+
+
+def log_prune(environment_id, keep=LOG_RUNS_KEPT):
+    """
+    Deletes the logs of all but the `keep` latest runs of an environment.
+    """
+    paths = sorted(glob.glob(log_path(environment_id, "*")), key=os.path.getmtime, reverse=True)
+    for path in paths[keep:]:
+        for rotated in [path] + glob.glob("%s.*" % (path,)):
+            os.remove(rotated)
+
+
+def log_prune_deleted(environment_ids):
+    """
+    Deletes the logs of the environments not in `environment_ids`.
+    """
+    keep = set(str(pk) for pk in environment_ids)
+    for name in os.listdir(LOGS_PATH) if os.path.isdir(LOGS_PATH) else []:
+        if name not in keep:
+            shutil.rmtree(os.path.join(LOGS_PATH, name), ignore_errors=True)
+
+
+class RunLog(object):
+    """
+    Output of the commands run by a pipeline on an environment. Lines are appended to the
+    log file of the run, rotated when it grows beyond `max_bytes`, and to a ring buffer of
+    the last LOG_BUFFER_LINES lines of the environment, kept in Redis.
+    """
+
+    def __init__(self, environment_id, run, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+        self.environment_id = environment_id
+        self.run = run
+        self.path = log_path(environment_id, run)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        log_prune(environment_id, keep=LOG_RUNS_KEPT - 1)
+        self.file = open(self.path, "ab")
+        self.size = self.file.tell()
+        self._buffer_clear()
+
+    def write(self, line):
+        data = line.encode("utf-8", "replace")
+        with self.lock:
+            if self.size and self.size + len(data) > self.max_bytes:
+                self._rotate()
+            self.file.write(data)
+            self.file.flush()
+            self.size += len(data)
+            self._buffer_append(line)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def _rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists("%s.%d" % (self.path, i)):
+                os.rename("%s.%d" % (self.path, i), "%s.%d" % (self.path, i + 1))
+        if self.backups:
+            os.rename(self.path, "%s.1" % (self.path,))
+        self.file = open(self.path, "wb")
+        self.size = 0
+
+    def _buffer_clear(self):
+        try:
+            redis_client().delete(log_buffer_key(self.environment_id))
+        except RedisError:
+            pass
+
+    def _buffer_append(self, line):
+        # Like notifications, never fails the command being run
+        key = log_buffer_key(self.environment_id)
+        try:
+            redis_client().pipeline(transaction=False).rpush(key, line).ltrim(key, -LOG_BUFFER_LINES, -1).execute()
+        except RedisError:
+            pass
+
+
+def log_buffer(environment_id):
+    """
+    The last lines written to the log of an environment, or None if not available.
+    """
+    try:
+        lines = redis_client().lrange(log_buffer_key(environment_id), 0, -1)
+    except RedisError:
+        return None
+    return "".join(line.decode("utf-8", "replace") for line in lines)
+
+
+def log_tail(environment_id, run, offset=None, limit=LOG_TAIL_BYTES):
+    """
+    Reads the log of a run from the byte `offset`, at most `limit` bytes. Without an offset,
+    returns the recent lines. Returns a tuple (text, next offset, whether output was missed,
+    whether more is available), where output is missed when the log was rotated since the
+    previous read.
+    """
+    path = log_path(environment_id, run)
+    if not os.path.exists(path):
+        return "", 0, False, False
+    size = os.path.getsize(path)
+    missed = False
+    if offset is None:
+        if run == log_latest_run(environment_id):
+            recent = log_buffer(environment_id)
+            if recent is not None:
+                return recent, size, False, False
+        offset = max(0, size - limit)
+    elif offset > size:
+        offset, missed = 0, True
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read(limit)
+    # Only return whole lines, unless a single line is larger than the limit
+    if len(data) == limit and b"\n" in data:
+        data = data[:data.rindex(b"\n") + 1]
+    offset += len(data)
+    return data.decode("utf-8", "replace"), offset, missed, offset < size
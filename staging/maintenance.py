@@ -0,0 +1,65 @@
+import time
+
+from django.utils import timezone
+
+from staging.postgres import PostgresError, postgres_batch, postgres_database_size
+from wonderbot.settings import DB_MAINTENANCE_WINDOW, DB_MAINTENANCE_VACUUM_FULL, DB_MAINTENANCE_COST_DELAY
+
+
+def in_maintenance_window(now=None):
+    """
+    Whether the current time is inside the nightly maintenance window. Its hours are in
+    TIME_ZONE, like the schedule starting the maintenance (CELERY_TIMEZONE), whatever
+    the time zone of the host.
+    """
+    start, end = DB_MAINTENANCE_WINDOW
+    hour = timezone.localtime(now or timezone.now()).hour
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+def database_analyze(database):
+    """
+    Collects planner statistics, which pg_restore does not do.
+    """
+    postgres_batch(["ANALYZE;"], database=database, transaction=False)
+
+
+def database_vacuum(database):
+    """
+    Vacuums a single database, throttled so as not to starve the other environments,
+    and records its size before and after.
+    """
+    from staging.models import DatabaseMaintenance
+    record = DatabaseMaintenance(database=database)
+    started = time.time()
+    record.size_before = postgres_database_size(database)
+    statements = ["SET vacuum_cost_delay = %d;" % (DB_MAINTENANCE_COST_DELAY,),
+                  "VACUUM ANALYZE;"]
+    if DB_MAINTENANCE_VACUUM_FULL:
+        statements.append("VACUUM FULL;")
+    postgres_batch(statements, database=database, transaction=False)
+    record.size_after = postgres_database_size(database)
+    record.duration = time.time() - started
+    record.save()
+    return record
+
+
+def maintenance_run(databases):
+    """
+    Vacuums the given databases one at a time, stopping at the end of the
+    maintenance window. Returns the list of databases which were not processed.
+    """
+    databases = list(databases)
+    while databases:
+        if not in_maintenance_window():
+            print("# Maintenance window is over, %d databases left." % len(databases))
+            break
+        database = databases.pop(0)
+        try:
+            database_vacuum(database)
+        except PostgresError as e:
+            # The environment may have been deleted in the meantime
+            print("# Maintenance of %s failed: %s" % (database, e))
+    return databases
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.1 on 2017-05-20 10:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('staging', '0004_allowedrepository'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DatabaseTemplate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(blank=True, max_length=64)),
+                ('status', models.CharField(choices=[('building', 'Building'), ('ready', 'Ready'), ('failed', 'Failed')], default='building', max_length=16)),
+                ('dump_signature', models.CharField(db_index=True, max_length=64)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='environment',
+            name='db_template_generation',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.1 on 2017-05-21 09:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('staging', '0005_databasetemplate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DatabaseMaintenance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('database', models.CharField(db_index=True, max_length=64)),
+                ('size_before', models.BigIntegerField(blank=True, null=True)),
+                ('size_after', models.BigIntegerField(blank=True, null=True)),
+                ('duration', models.FloatField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
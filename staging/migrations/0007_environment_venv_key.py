@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.1 on 2017-05-22 16:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('staging', '0006_databasemaintenance'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='environment',
+            name='venv_key',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.1 on 2017-05-24 11:27
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('staging', '0007_environment_venv_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StageRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('environment_name', models.CharField(db_index=True, max_length=64)),
+                ('operation', models.CharField(max_length=16)),
+                ('run', models.CharField(db_index=True, max_length=32)),
+                ('stage', models.CharField(db_index=True, max_length=64)),
+                ('started', models.DateTimeField()),
+                ('duration', models.FloatField(blank=True, null=True)),
+                ('exit_code', models.IntegerField(blank=True, null=True)),
+                ('output_size', models.BigIntegerField(default=0)),
+                ('environment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='stage_runs', to='staging.Environment')),
+            ],
+            options={
+                'ordering': ['-started'],
+            },
+        ),
+    ]
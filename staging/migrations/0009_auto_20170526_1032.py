@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.1 on 2017-05-26 10:32
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('staging', '0008_stagerun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='environment',
+            name='deployed_sha',
+            field=models.CharField(blank=True, max_length=40),
+        ),
+        migrations.AddField(
+            model_name='environment',
+            name='update_pending',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.1 on 2017-05-29 17:14
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('staging', '0009_auto_20170526_1032'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='environment',
+            name='status',
+            field=models.CharField(choices=[('creating', 'Creating'), ('active', 'Active'), ('updating', 'Updating'), ('refresing', 'Refreshing'), ('deleting', 'Deleting'), ('failed', 'Failed')], default='creating', max_length=16),
+        ),
+    ]
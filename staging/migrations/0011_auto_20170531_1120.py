@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.1 on 2017-05-31 11:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('staging', '0010_auto_20170529_1714'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='environment',
+            name='uwsgi_processes',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='environment',
+            name='uwsgi_threads',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.1 on 2017-06-01 09:45
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('staging', '0011_auto_20170531_1120'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Snapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64)),
+                ('database', models.CharField(max_length=64, unique=True)),
+                ('sha', models.CharField(blank=True, max_length=40)),
+                ('status', models.CharField(choices=[('creating', 'Creating'), ('ready', 'Ready'), ('deleting', 'Deleting'), ('failed', 'Failed')], default='creating', max_length=16)),
+                ('automatic', models.BooleanField(default=False)),
+                ('size', models.BigIntegerField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('environment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='staging.Environment')),
+            ],
+            options={
+                'ordering': ['-created'],
+            },
+        ),
+    ]
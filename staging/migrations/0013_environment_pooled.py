@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.1 on 2017-06-02 10:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('staging', '0012_snapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='environment',
+            name='pooled',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.1 on 2017-06-05 15:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('staging', '0013_environment_pooled'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookDelivery',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('delivery', models.CharField(max_length=64, unique=True)),
+                ('event', models.CharField(max_length=32)),
+                ('payload', models.TextField()),
+                ('result', models.TextField(blank=True)),
+                ('received', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('processed', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
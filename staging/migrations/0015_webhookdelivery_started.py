@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.1 on 2017-06-07 10:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('staging', '0014_webhookdelivery'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webhookdelivery',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='webhookdelivery',
+            name='started',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
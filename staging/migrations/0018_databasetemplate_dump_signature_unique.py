@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.1 on 2017-06-08 14:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def rename_duplicates(apps, schema_editor):
+    """
+    Gives the older templates of a same dump a signature of their own, they are dropped
+    as outdated anyway.
+    """
+    DatabaseTemplate = apps.get_model('staging', 'DatabaseTemplate')
+    seen = set()
+    for template in DatabaseTemplate.objects.order_by('-pk'):
+        if template.dump_signature in seen:
+            template.dump_signature = "%s-%d" % (template.dump_signature[:48], template.pk)
+            template.save(update_fields=['dump_signature'])
+        seen.add(template.dump_signature)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('staging', '0017_environment_update_queued'),
+    ]
+
+    operations = [
+        migrations.RunPython(rename_duplicates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='databasetemplate',
+            name='dump_signature',
+            field=models.CharField(max_length=64, unique=True),
+        ),
+    ]
@@ -1,11 +1,43 @@
-from django.db import models
+import datetime
+import glob
+import os
+import traceback
+
+from django.db import IntegrityError, models, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.functional import cached_property
+from kombu.exceptions import OperationalError
+from redis.exceptions import RedisError
 
 import staging.cmd as cmd
-from staging.github import github_finished, github_pending
-from staging.utils import random_username, random_password
+from staging.changes import Changes
+from staging.github import github_failed, github_finished, github_pending, github_superseded
+from staging.locks import redis_client
+from staging.logs import log_prune_deleted
+from staging.maintenance import database_analyze
+from staging.notifications import notify_environment_changed
+from staging.pipeline import CREATION, DELETION, RECREATION, REFRESH, UPDATE, PipelineCancelled, StageFailed, \
+    incremental_update
+from staging.postgres import PostgresError, postgres_batch, postgres_restore, postgres_dump_signature, \
+    postgres_database_size, \
+    sql_alter_tables_owner, sql_create_role_if_not_exists, sql_terminate_connections
+from staging.repositories import mirror_diff, mirror_fetch, mirror_resolve, worktree_add, worktree_checkout, \
+    worktree_move, worktree_prune
+from staging.statics import static_collect, static_sources, static_store_gc
+from staging.utils import random_username, random_password, is_sha, percentile
 from staging.validators import validate_environment_name
-from wonderbot.settings import DEFAULT_REPOSITORY_URL, DEFAULT_BRANCH, HIGH_LEVEL_DOMAIN, UWSGI_SOCKETS_PATH, \
-    NGINX_ROOTS, DB_DUMP_FILENAME, DB_DUMP_WORKERS, DB_STOP_SCRIPT, SUDO_BIN, DB_START_SCRIPT, SKELETON_CONFIGURATION
+from staging.vassals import vassal_sizing, vassal_state_cached, vassal_states_refresh, vassal_write
+from staging.venvs import venv_ensure, venv_evict, venv_key, venv_link
+from wonderbot.settings import DEFAULT_REPOSITORY_URL, DEFAULT_BRANCH, HIGH_LEVEL_DOMAIN, \
+    NGINX_ROOTS, DB_STOP_SCRIPT, SUDO_BIN, DB_START_SCRIPT, SKELETON_CONFIGURATION, \
+    DB_TEMPLATE_ENABLED, DB_TEMPLATE_PREFIX, DB_TEMPLATE_OWNER, DB_RESTART_ON_DELETE, STAGE_STATISTICS_WINDOW, \
+    UPDATE_DEBOUNCE_SECONDS, UPDATE_PENDING_TIMEOUT, GIT_MIRROR_FETCH_MAX_AGE, DB_SNAPSHOT_OWNER, \
+    DB_SNAPSHOT_AUTOMATIC, \
+    DB_SNAPSHOTS_MAX, DB_SNAPSHOTS_MAX_BYTES, POOL_SIZE, POOL_NAME_PREFIX, POOL_MAX_AGE, WEBHOOK_REQUEUE_AFTER, \
+    WEBHOOK_CLAIM_TIMEOUT, WEBHOOK_ATTEMPTS, WEBHOOK_DELIVERIES_KEPT, HOUSEKEEPING_DELAY
+
+HOUSEKEEPING_KEY = "wonderbot:housekeeping"
 
 
 class Environment(models.Model):
@@ -16,11 +48,13 @@ class Environment(models.Model):
     UPDATING = 'updating'
     REFRESHING = 'refresing'
     DELETING = 'deleting'
+    FAILED = 'failed'
     STATUS = ((CREATING, "Creating"),
               (ACTIVE, "Active"),
               (UPDATING, "Updating"),
               (REFRESHING, "Refreshing"),
-              (DELETING, "Deleting"))
+              (DELETING, "Deleting"),
+              (FAILED, "Failed"))
     
     # Protocol constants
     HTTP = "http"
@@ -34,6 +68,9 @@ class Environment(models.Model):
     repository = models.CharField(blank=False, null=False, default=DEFAULT_REPOSITORY_URL, max_length=64)
     branch = models.CharField(blank=False, null=False, default=DEFAULT_BRANCH, max_length=64)
     sha = models.CharField(blank=True, max_length=40)
+    deployed_sha = models.CharField(blank=True, max_length=40)
+    update_pending = models.BooleanField(default=False)
+    update_queued = models.DateTimeField(blank=True, null=True)
     protocol = models.CharField(blank=False, null=False, default=HTTP, choices=PROTOCOL, max_length=8)
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
@@ -42,6 +79,32 @@ class Environment(models.Model):
     db_name = models.CharField(blank=True, null=True, max_length=64)
     db_user = models.CharField(blank=True, null=True, max_length=64)
     db_pass = models.CharField(blank=True, null=True, max_length=64)
+    db_template_generation = models.PositiveIntegerField(blank=True, null=True)
+
+    # Key of the cached virtualenv in use
+    venv_key = models.CharField(blank=True, max_length=64)
+
+    # uWSGI workers, computed from the capacity of the host unless set (e.g. for load tests)
+    uwsgi_processes = models.PositiveSmallIntegerField(blank=True, null=True)
+    uwsgi_threads = models.PositiveSmallIntegerField(blank=True, null=True)
+
+    # Built in advance for the warm pool, not assigned to a pull request yet
+    pooled = models.BooleanField(default=False)
+    # Name the environment was built under in the pool, until its files are moved to the new one
+    previous_name = models.CharField(blank=True, max_length=64)
+
+    # Set when the mirror has just been fetched for the current operation, e.g. by its batch
+    mirror_fetched = False
+
+    def save(self, *args, **kwargs):
+        super(Environment, self).save(*args, **kwargs)
+        notify_environment_changed(self.pk)
+
+    def delete(self, *args, **kwargs):
+        pk = self.pk
+        result = super(Environment, self).delete(*args, **kwargs)
+        notify_environment_changed(pk)
+        return result
 
     @property
     def short_sha(self):
@@ -52,6 +115,35 @@ class Environment(models.Model):
 
     def url(self):
         return "%s://%s" % (self.protocol, self.host())
+
+    @classmethod
+    def serving(cls):
+        """
+        The environments which have, or are about to have, a running vassal.
+        """
+        return cls.objects.exclude(status__in=[cls.DELETING, cls.FAILED])
+
+    @cached_property
+    def vassal_state(self):
+        return vassal_state_cached(self.name)
+
+    @classmethod
+    def vassals_probe(cls):
+        """
+        Probes the state of the vassals, and tells the dashboards about the ones which changed.
+        """
+        environments = dict(cls.objects.values_list('name', 'pk'))
+        for name in vassal_states_refresh(list(environments)):
+            notify_environment_changed(environments[name])
+
+    def vassal_configure(self, sizing=None):
+        """
+        Writes the uwsgi.ini of the environment, sized for the host unless overridden.
+        Returns whether it has changed.
+        """
+        processes, threads = sizing or vassal_sizing(Environment.serving().count())
+        return vassal_write(self.name, self._get_nginx_root(),
+                            processes=self.uwsgi_processes or processes, threads=self.uwsgi_threads or threads)
     
     def __str__(self):
         return "%s (%s, %s)" % (self.name, self.protocol, self.get_status_display())
@@ -60,128 +152,500 @@ class Environment(models.Model):
         self.status = self.CREATING
         self.save()
         from wonderbot.celery import environment_create
-        environment_create.delay(self)
+        environment_create.delay(self.pk)
 
     def queue_for_recreation(self):
         self.status = self.CREATING
         self.save()
         from wonderbot.celery import environment_recreate
-        environment_recreate.delay(self)
+        environment_recreate.delay(self.pk)
 
     def queue_for_deletion(self):
         self.status = self.DELETING
         self.save()
         from wonderbot.celery import environment_delete
-        environment_delete.delay(self)
+        environment_delete.delay(self.pk)
 
-    def queue_for_update(self):
-        self.status = self.UPDATING
-        self.save()
+    def queue_for_update(self, sha=None):
+        """
+        Queues an update of the environment. When `sha` is given (i.e. on push), the update
+        is debounced: pushes arriving before it starts are absorbed by it, so that only the
+        latest sha is deployed, and an update already running is cancelled between stages.
+        """
         from wonderbot.celery import environment_update
-        environment_update.delay(self)
+        if sha is None:
+            self.status = self.UPDATING
+            self.save()
+            environment_update.delay(self.pk)
+            return
+
+        previous = Environment.objects.filter(pk=self.pk).values_list('sha', flat=True).first()
+        self.sha, self.status = sha, self.UPDATING
+        Environment.objects.filter(pk=self.pk).update(sha=sha, status=self.UPDATING,
+                                                      updated=timezone.now())
+        # Only one update may be waiting to start, claim it atomically
+        now = timezone.now()
+        claimed = Environment.objects.filter(Environment.q_update_unclaimed(now), pk=self.pk)\
+            .update(update_pending=True, update_queued=now)
+        notify_environment_changed(self.pk)
+        self.update_pending = True
+        if claimed:
+            environment_update.apply_async((self.pk,), {"full": False}, countdown=UPDATE_DEBOUNCE_SECONDS)
+        elif previous not in (sha, self.deployed_sha):
+            # The waiting update will deploy the new sha instead
+            github_superseded(previous, sha)
+
+    @classmethod
+    def q_update_unclaimed(cls, now):
+        """
+        Environments with no update waiting to start, or only one queued so long ago that
+        it was lost (e.g. with its worker).
+        """
+        lost = now - datetime.timedelta(seconds=UPDATE_PENDING_TIMEOUT)
+        return Q(update_pending=False) | Q(update_queued__isnull=True) | Q(update_queued__lt=lost)
+
+    @classmethod
+    def updates_recover(cls):
+        """
+        Queues again the updates which were lost: otherwise, their environments would stay
+        updating, and absorb every push, until the next one.
+        """
+        for environment in cls.objects.filter(cls.q_update_unclaimed(timezone.now()), update_pending=True):
+            print("# Update of %s lost, queued again." % (environment.name,))
+            environment.queue_for_update(environment.sha)
+
+    @classmethod
+    def queue_batch(cls, action, ids):
+        """
+        Queues the same action ("refresh", "update", "recreate" or "delete") on several
+        environments, as a single batch sharing the common work.
+        """
+        status = {"refresh": cls.REFRESHING, "update": cls.UPDATING,
+                  "recreate": cls.CREATING, "delete": cls.DELETING}[action]
+        ids = list(cls.objects.filter(pk__in=ids).values_list('pk', flat=True))
+        if not ids:
+            return
+        # Like save(), so that the dashboards see the change
+        cls.objects.filter(pk__in=ids).update(status=status, updated=timezone.now())
+        for pk in ids:
+            notify_environment_changed(pk)
+        from wonderbot.celery import environments_batch
+        # Deletions are always fast-tracked
+        options = {"queue": "delete"} if action == "delete" else {}
+        environments_batch.apply_async((action, ids), **options)
+
+    def queue_for_snapshot(self, name, automatic=False):
+        snapshot = Snapshot.objects.create(environment=self, name=name, automatic=automatic,
+                                           sha=self.deployed_sha or self.sha)
+        from wonderbot.celery import environment_snapshot
+        environment_snapshot.delay(self.pk, snapshot.pk)
+        return snapshot
+
+    def queue_for_snapshot_restore(self, snapshot):
+        self.status = self.REFRESHING
+        self.save()
+        from wonderbot.celery import environment_snapshot_restore
+        environment_snapshot_restore.delay(self.pk, snapshot.pk)
+
+    def queue_for_snapshot_deletion(self, snapshot):
+        snapshot.status = Snapshot.DELETING
+        snapshot.save()
+        from wonderbot.celery import environment_snapshot_delete
+        environment_snapshot_delete.delay(self.pk, snapshot.pk)
+
+    @classmethod
+    def pool_claim(cls, name, repository, branch, sha):
+        """
+        Assigns a ready environment of the warm pool to a pull request, and queues its
+        takeover. Returns the environment, or None if the pool has none for the repository.
+        """
+        for candidate in cls.objects.filter(pooled=True, status=cls.ACTIVE, repository=repository)\
+                .order_by('-created'):
+            # Claimed atomically, the same environment could be claimed by another request
+            claimed = cls.objects.filter(pk=candidate.pk, pooled=True, status=cls.ACTIVE)\
+                .update(pooled=False, status=cls.CREATING, name=name, previous_name=candidate.name,
+                        branch=branch, sha=sha, updated=timezone.now())
+            if not claimed:
+                continue
+            notify_environment_changed(candidate.pk)
+            from wonderbot.celery import environment_claim, pool_refill
+            environment_claim.delay(candidate.pk)
+            pool_refill.delay()
+            candidate.refresh_from_db()
+            return candidate
+        return None
+
+    @classmethod
+    def pool_refill(cls):
+        """
+        Queues the creation of the environments missing from the warm pool. Members built from
+        an older database template, or older than POOL_MAX_AGE, are replaced: they are only
+        deleted once enough new ones are ready, so that they can be claimed in the meantime.
+        """
+        template = DatabaseTemplate.get_current() if DB_TEMPLATE_ENABLED else None
+        oldest = timezone.now() - datetime.timedelta(seconds=POOL_MAX_AGE)
+        pool = list(cls.objects.filter(pooled=True).exclude(status=cls.DELETING))
+        outdated = [e for e in pool if e.status == cls.FAILED or e.created < oldest or
+                    (template and e.status == cls.ACTIVE and e.db_template_generation != template.generation)]
+        current = [e for e in pool if e not in outdated]
+        ready = [e for e in current if e.status == cls.ACTIVE]
+
+        for environment in outdated:
+            if environment.status != cls.FAILED and len(ready) < POOL_SIZE:
+                continue
+            retired = cls.objects.filter(pk=environment.pk, pooled=True, status=environment.status)\
+                .update(status=cls.DELETING, updated=timezone.now())
+            if retired:
+                notify_environment_changed(environment.pk)
+                from wonderbot.celery import environment_delete
+                environment_delete.delay(environment.pk)
+
+        for _ in range(POOL_SIZE - len(current)):
+            environment = cls(name="%s%s" % (POOL_NAME_PREFIX, random_username(8)), pooled=True,
+                              repository=DEFAULT_REPOSITORY_URL, branch=DEFAULT_BRANCH)
+            environment.save()
+            from wonderbot.celery import environment_pool_create
+            environment_pool_create.delay(environment.pk)
 
     def queue_for_refresh(self):
         self.status = self.REFRESHING
         self.save()
         from wonderbot.celery import environment_refresh
-        environment_refresh.delay(self)
+        environment_refresh.delay(self.pk)
 
     def do_creation(self):
         github_pending(self.sha)
-        self._git_clone()
-        self._python_venv_setup()
-        self._database_create()
-        self._jorvik_configure()
-        self._django_apply_migrations()
-        self._django_collect_static()
-        self._uwsgi_touch()
-        self.status = self.ACTIVE
-        self.save()
+        self._run_pipeline(CREATION, "creation")
+        self.status, self.deployed_sha = self.ACTIVE, self.sha
+        self._save_fields("status", "deployed_sha")
+        github_finished(self)
+
+    def do_pool_creation(self):
+        # Deploys the head of the branch, nobody is waiting for a commit status
+        self._run_pipeline(CREATION, "pool creation")
+        self.status, self.deployed_sha = self.ACTIVE, self.sha
+        self._save_fields("status", "deployed_sha")
+
+    def do_claim(self):
+        """
+        Takes over an environment of the warm pool, built as `previous_name`: moves it to its
+        new name, then deploys the sha of the pull request, running only the stages required
+        by the changes since the sha the environment was built at.
+        """
+        github_pending(self.sha)
+        try:
+            self._pool_rebind()
+        except cmd.CommandError:
+            self._failed("pool_rebind")
+            raise
+        self._run_pipeline(self._incremental_update_pipeline(), "claim")
+        self.status, self.deployed_sha = self.ACTIVE, self.sha
+        self._save_fields("status", "deployed_sha")
+        github_finished(self)
+
+    def do_recreation(self):
+        github_pending(self.sha)
+        self._run_pipeline(RECREATION, "recreation")
+        self.status, self.deployed_sha = self.ACTIVE, self.sha
+        self._save_fields("status", "deployed_sha")
         github_finished(self)
 
     def do_refresh(self):
-        self._database_refresh()
-        self._jorvik_configure()
-        self._django_apply_migrations()
-        self._uwsgi_touch()
+        self._run_pipeline(REFRESH, "refresh")
         self.status = self.ACTIVE
-        self.save()
+        self._save_fields("status")
 
-    def do_update(self):
-        github_pending(self.sha)
-        self._git_pull()
-        self._django_collect_static()
-        self.do_refresh()
+    def do_snapshot(self, snapshot):
+        try:
+            self._snapshot_take(snapshot)
+        except PostgresError:
+            if snapshot.automatic:
+                # Nobody asked for it, the next migrations take another one
+                snapshot.drop()
+            else:
+                snapshot.status = Snapshot.FAILED
+                snapshot.save()
+            raise
+
+    def do_snapshot_restore(self, snapshot):
+        try:
+            self._snapshot_restore(snapshot)
+        except (PostgresError, cmd.CommandError):
+            self.status = self.FAILED
+            self._save_fields("status")
+            raise
+        self.status = self.ACTIVE
+        self._save_fields("status")
+
+    def do_snapshot_delete(self, snapshot):
+        snapshot.drop()
+
+    def do_update(self, full=True):
+        """
+        Deploys the latest sha. A full update pulls, collects static files and refreshes the database.
+        Otherwise, nothing is done if that sha is already deployed, only the stages required by the
+        changes since the deployed sha are run, and the update stops as soon as a newer sha is pushed.
+        """
+        Environment.objects.filter(pk=self.pk).update(update_pending=False)
+        self.refresh_from_db()
+        target = self.sha
+        if not full and target == self.deployed_sha:
+            self._update_finished(target)
+            return
+
+        github_pending(target)
+        try:
+            if full:
+                self._run_pipeline(UPDATE, "update")
+            else:
+                self._run_pipeline(self._incremental_update_pipeline(), "incremental update",
+                                   cancelled=lambda: self._is_superseded(target))
+        except PipelineCancelled:
+            newer = Environment.objects.filter(pk=self.pk).values_list('sha', flat=True).first()
+            github_superseded(target, newer)
+            return
+        # A full update deploys the current head of the branch, which may be newer
+        target = self.sha
+        self._update_finished(target)
         github_finished(self)
 
+    def _incremental_update_pipeline(self):
+        if not is_sha(self.deployed_sha):
+            return UPDATE
+        # Runs before the pipeline, so its failures are not reported by _run_pipeline
+        try:
+            self._git_fetch()
+            diff = mirror_diff(self.repository, self.deployed_sha, self.sha)
+        except cmd.CommandError:
+            self._failed("git_fetch")
+            raise
+        if diff is None:
+            return UPDATE
+        changes = Changes(diff)
+        print("# Changes from %s to %s: %s" % (self.deployed_sha[:8], self.sha[:8], changes))
+        return incremental_update(changes)
+
+    def _run_pipeline(self, pipeline, operation, **kwargs):
+        try:
+            pipeline.run(self, operation, **kwargs)
+        except StageFailed as e:
+            self._failed(e.stage)
+            raise
+        if DB_SNAPSHOT_AUTOMATIC and not self.pooled and \
+                any(stage.name == "django_apply_migrations" for stage in pipeline.stages):
+            # Taken in the background, once this operation has released the environment,
+            # rather than delaying it by a copy of the whole database
+            self.queue_for_snapshot(Snapshot.MIGRATED, automatic=True)
+
+    def _failed(self, stage):
+        self.status = self.FAILED
+        self._save_fields("status")
+        if not self.pooled:
+            github_failed(self, stage)
+
+    def _update_finished(self, sha):
+        self.deployed_sha = sha
+        self._save_fields("deployed_sha")
+        # Leave the environment as updating if a newer update is already queued
+        Environment.objects.filter(pk=self.pk, update_pending=False)\
+            .update(status=self.ACTIVE, updated=timezone.now())
+        notify_environment_changed(self.pk)
+
+    def _is_superseded(self, sha):
+        return Environment.objects.filter(pk=self.pk).values_list('sha', flat=True).first() != sha
+
+    def _save_fields(self, *fields):
+        """
+        Saves only some fields, so that work running in the background does not
+        overwrite changes made in the meantime (e.g. a new sha being pushed).
+        """
+        self.save(update_fields=list(fields) + ["updated"])
+
     def do_delete(self, delete_object=True):
-        self._nginx_delete()
-        self._database_delete()
+        self._run_pipeline(DELETION, "deletion")
         if delete_object:
             self.delete()
 
     def _nginx_delete(self):
         self._delete_nginx_root()
+        if self.previous_name:
+            # Claimed from the pool, but never moved to its new name
+            cmd.dir_delete("%s/%s" % (NGINX_ROOTS, self.previous_name))
+            self.previous_name = ""
+            self._save_fields("previous_name")
+        worktree_prune(self.repository)
+
+    def _pool_rebind(self):
+        if not self.previous_name:
+            return
+        previous = "%s/%s" % (NGINX_ROOTS, self.previous_name)
+        # Already moved if a previous attempt failed afterwards
+        if os.path.isdir(previous):
+            self._delete_nginx_root()
+            worktree_move(self.repository, previous, self._get_nginx_root())
+        # Paths and sockets depend on the name
+        self._jorvik_configure()
+        self.previous_name = ""
+        self._save_fields("previous_name")
 
     def _git_clone(self):
-        cmd.bash_execute("git clone -b %s %s %s" % (self.branch, self.repository, self.name),
-                         cwd=NGINX_ROOTS)
+        self._git_fetch()
+        worktree_add(self.repository, self._get_nginx_root(), self.sha)
 
     def _git_pull(self):
-        cmd.bash_execute("git pull",
-                         cwd=self._get_nginx_root())
+        if os.path.isdir("%s/.git" % self._get_nginx_root()):
+            # Environment created as a full clone, before mirrors were introduced
+            cmd.execute(["git", "pull"], cwd=self._get_nginx_root(), kind="git")
+            return
+        self._git_fetch()
+        worktree_checkout(self._get_nginx_root(), self.sha)
+
+    def _git_pull_latest(self):
+        self._git_fetch(latest=True)
+        self._git_pull()
+
+    def _git_fetch(self, latest=False):
+        if is_sha(self.sha) and not latest:
+            mirror_fetch(self.repository, self.sha)
+            return
+        # Created manually or explicitly updated, deploy the current head of the branch
+        if not self.mirror_fetched:
+            mirror_fetch(self.repository, max_age=GIT_MIRROR_FETCH_MAX_AGE)
+        self.sha = mirror_resolve(self.repository, self.branch) or ""
+        self._save_fields("sha")
 
     def _python_venv_setup(self):
-        cmd.bash_execute("python3 -m virtualenv -ppython3 .venv", cwd=self._get_nginx_root())
-        cmd.bash_execute("pip install -r requirements.txt", cwd=self._get_nginx_root(), venv=".venv")
+        self.venv_key = venv_ensure("%s/requirements.txt" % (self._get_nginx_root(),))
+        venv_link(self.venv_key, self._get_nginx_root())
+        self._save_fields("venv_key")
+
+    def _python_venv_update(self):
+        # Only reinstall dependencies if requirements.txt has changed
+        if venv_key("%s/requirements.txt" % (self._get_nginx_root(),)) != self.venv_key:
+            self._python_venv_setup()
 
     def _database_create(self):
         self._postgres_generate_credentials()
-        self._postgres_cmd("CREATE USER %s WITH PASSWORD '%s';" % (self.db_user, self.db_pass))
-        self._postgres_cmd("CREATE DATABASE %s OWNER %s;" % (self.db_name, self.db_user))
-        self._postgres_cmd("GRANT ALL PRIVILEGES ON DATABASE %s TO %s;" % (self.db_name, self.db_user))
-        self._postgres_cmd("GRANT ALL PRIVILEGES ON DATABASE %s TO %s;" % (self.db_name, "staging"))
+        template = DatabaseTemplate.get_current() if DB_TEMPLATE_ENABLED else None
+        if template:
+            self._postgres_clone_template(template)
+            return
+        self._postgres_batch([
+            "CREATE USER %s WITH PASSWORD '%s';" % (self.db_user, self.db_pass),
+            "CREATE DATABASE %s OWNER %s;" % (self.db_name, self.db_user),
+            "GRANT ALL PRIVILEGES ON DATABASE %s TO %s;" % (self.db_name, self.db_user),
+            "GRANT ALL PRIVILEGES ON DATABASE %s TO %s;" % (self.db_name, "staging"),
+        ], transaction=False)
         self._postgres_import_dump()
+        self.db_template_generation = None
+        self._save_fields("db_template_generation")
+
+    def _postgres_clone_template(self, template):
+        # File-level copy of the template, then hand over everything the template owner owns
+        self._postgres_batch([
+            "CREATE USER %s WITH PASSWORD '%s';" % (self.db_user, self.db_pass),
+            "CREATE DATABASE %s TEMPLATE %s OWNER %s;" % (self.db_name, template.name, self.db_user),
+            "GRANT ALL PRIVILEGES ON DATABASE %s TO %s;" % (self.db_name, self.db_user),
+            "GRANT ALL PRIVILEGES ON DATABASE %s TO %s;" % (self.db_name, "staging"),
+        ], transaction=False)
+        self._postgres_take_ownership(DB_TEMPLATE_OWNER)
+        self.db_template_generation = template.generation
+        self._save_fields("db_template_generation")
+
+    def _postgres_take_ownership(self, owner):
+        """
+        Hands over to the environment's user everything `owner` owns in its database.
+        """
+        self._postgres_batch([
+            "REASSIGN OWNED BY %s TO %s;" % (owner, self.db_user),
+            "GRANT ALL ON ALL TABLES IN SCHEMA public TO %s;" % (self.db_user,),
+            "GRANT ALL ON ALL SEQUENCES IN SCHEMA public TO %s;" % (self.db_user,),
+            "GRANT ALL ON ALL FUNCTIONS IN SCHEMA public TO %s;" % (self.db_user,),
+        ], database=self.db_name)
 
     def _postgres_import_dump(self):
-        cmd.bash_execute("pg_restore -Fc -d %s -U %s -j %d --no-owner --no-privileges %s" % (
-                         self.db_name, "staging",
-                         DB_DUMP_WORKERS, DB_DUMP_FILENAME))
-        self._postgres_cmd("GRANT ALL PRIVILEGES ON DATABASE %s TO %s;" % (self.db_name, self.db_user))
-        self._postgres_cmd("ALTER DATABASE %s OWNER TO %s;" % (self.db_name, self.db_user))
-        self._postgres_cmd("ALTER SCHEMA public OWNER TO %s;" % (self.db_user,), database=self.db_name)
-        self._postgres_cmd("ALTER SCHEMA information_schema OWNER TO %s;" % (self.db_user,), database=self.db_name)
-        self._postgres_cmd("GRANT ALL ON ALL TABLES IN SCHEMA public TO %s;" % (self.db_user,), database=self.db_name)
-        self._postgres_cmd("GRANT ALL ON ALL TABLES IN SCHEMA information_schema TO %s;" % (self.db_user,), database=self.db_name)
-        self._postgres_cmd("GRANT ALL ON ALL SEQUENCES IN SCHEMA public TO %s;" % (self.db_user,), database=self.db_name)
-        self._postgres_cmd("GRANT ALL ON ALL SEQUENCES IN SCHEMA information_schema TO %s;" % (self.db_user,), database=self.db_name)
-        self._postgres_cmd("GRANT ALL ON ALL FUNCTIONS IN SCHEMA public TO %s;" % (self.db_user,), database=self.db_name)
-        self._postgres_cmd("GRANT ALL ON ALL FUNCTIONS IN SCHEMA information_schema TO %s;" % (self.db_user,), database=self.db_name)
-        # Generate ALTER TABLE ... OWNER TO query for each of the tables in the 'public' schema
-        cmd.bash_execute("psql %s -c \"SELECT 'ALTER TABLE '|| schemaname || '.' || tablename ||' OWNER TO %s;' "
-                                      "FROM pg_tables WHERE NOT schemaname IN ('pg_catalog', 'information_schema') "    
-                                      "ORDER BY schemaname, tablename;\" "
-                         "| cat | grep \"ALTER TABLE\" | "
-                         "psql %s" % (self.db_name, self.db_user, self.db_name))
-        # Run VACUUM commands to optimise space utilisation
-        self._postgres_cmd("VACUUM;", database=self.db_name)
-        self._postgres_cmd("VACUUM FULL;", database=self.db_name)
+        postgres_restore(self.db_name)
+        self._postgres_batch([
+            "GRANT ALL PRIVILEGES ON DATABASE %s TO %s;" % (self.db_name, self.db_user),
+            "ALTER DATABASE %s OWNER TO %s;" % (self.db_name, self.db_user),
+            "ALTER SCHEMA public OWNER TO %s;" % (self.db_user,),
+            "ALTER SCHEMA information_schema OWNER TO %s;" % (self.db_user,),
+            "GRANT ALL ON ALL TABLES IN SCHEMA public TO %s;" % (self.db_user,),
+            "GRANT ALL ON ALL TABLES IN SCHEMA information_schema TO %s;" % (self.db_user,),
+            "GRANT ALL ON ALL SEQUENCES IN SCHEMA public TO %s;" % (self.db_user,),
+            "GRANT ALL ON ALL SEQUENCES IN SCHEMA information_schema TO %s;" % (self.db_user,),
+            "GRANT ALL ON ALL FUNCTIONS IN SCHEMA public TO %s;" % (self.db_user,),
+            "GRANT ALL ON ALL FUNCTIONS IN SCHEMA information_schema TO %s;" % (self.db_user,),
+            sql_alter_tables_owner(self.db_user),
+        ], database=self.db_name)
+        database_analyze(self.db_name)
 
     def _database_delete(self):
         if not self.db_user:
             return
-        self._postgres_cmd("REVOKE ALL ON DATABASE %s FROM %s;" % (self.db_name, self.db_user))
-        self._postgres_restart()
-        self._postgres_cmd("DROP DATABASE %s;" % (self.db_name,))
-        self._postgres_cmd("DROP USER %s;" % (self.db_user,))
-        # Make sure to free up disk space immediately
-        self._postgres_cmd("VACUUM;")
-        self._postgres_cmd("VACUUM FULL;")
+        if DB_RESTART_ON_DELETE:
+            self._postgres_batch(["REVOKE ALL ON DATABASE %s FROM %s;" % (self.db_name, self.db_user)],
+                                 check=False)
+            self._postgres_restart()
+        else:
+            self._postgres_batch(sql_terminate_connections(self.db_name), transaction=False)
+        self._postgres_batch([
+            "DROP DATABASE IF EXISTS %s;" % (self.db_name,),
+            "DROP USER IF EXISTS %s;" % (self.db_user,),
+        ], transaction=False)
+
+    def _snapshots_delete(self):
+        for snapshot in self.snapshots.all():
+            snapshot.drop()
+
+    def _snapshot_take(self, snapshot):
+        # A database can only be copied while nobody is connected to it
+        try:
+            self._postgres_batch([sql_create_role_if_not_exists(DB_SNAPSHOT_OWNER)] +
+                                 sql_terminate_connections(self.db_name) +
+                                 ["CREATE DATABASE %s TEMPLATE %s OWNER staging;" % (snapshot.database, self.db_name)],
+                                 transaction=False)
+        finally:
+            self._postgres_batch(["ALTER DATABASE %s WITH ALLOW_CONNECTIONS true;" % (self.db_name,)],
+                                 transaction=False, check=False)
+        # Owned by a role of its own, and without any reference to the environment's user, which
+        # could not be dropped otherwise (e.g. on refresh). Both commands also apply to the
+        # databases of the user, the environment's is given back.
+        self._postgres_batch([
+            "REASSIGN OWNED BY %s TO %s;" % (self.db_user, DB_SNAPSHOT_OWNER),
+            "DROP OWNED BY %s;" % (self.db_user,),
+        ], database=snapshot.database)
+        self._postgres_batch([
+            "ALTER DATABASE %s OWNER TO %s;" % (self.db_name, self.db_user),
+            "GRANT ALL PRIVILEGES ON DATABASE %s TO %s;" % (self.db_name, self.db_user),
+        ])
+        snapshot.size = postgres_database_size(snapshot.database)
+        self._postgres_batch(["ALTER DATABASE %s WITH ALLOW_CONNECTIONS false;" % (snapshot.database,)],
+                             transaction=False)
+        snapshot.status = Snapshot.READY
+        snapshot.save()
+        # Replaces any snapshot with the same name
+        for s in self.snapshots.filter(name=snapshot.name, status=Snapshot.READY).exclude(pk=snapshot.pk):
+            s.drop()
+        Snapshot.enforce_limits(self, keep=snapshot)
+
+    def _snapshot_restore(self, snapshot):
+        self._postgres_batch(sql_terminate_connections(self.db_name) + [
+            "DROP DATABASE IF EXISTS %s;" % (self.db_name,),
+            "CREATE DATABASE %s TEMPLATE %s OWNER %s;" % (self.db_name, snapshot.database, self.db_user),
+            "GRANT ALL PRIVILEGES ON DATABASE %s TO %s;" % (self.db_name, self.db_user),
+            "GRANT ALL PRIVILEGES ON DATABASE %s TO %s;" % (self.db_name, "staging"),
+        ], transaction=False)
+        self._postgres_take_ownership(DB_SNAPSHOT_OWNER)
+        # The snapshot may predate migrations of the code deployed since
+        self._django_apply_migrations()
+        # Drop the connections the application may still have
+        self._uwsgi_touch()
 
     def _jorvik_configure(self):
         # Skeleton configuration
-        cmd.bash_execute("cp -R %s/* %s" % (SKELETON_CONFIGURATION,
-                                            self._get_nginx_root()))
+        cmd.execute(["cp", "-R"] + sorted(glob.glob("%s/*" % (SKELETON_CONFIGURATION,))) +
+                    [self._get_nginx_root()])
 
         # Write database configuration
         database = "[client]\n" \
@@ -206,55 +670,49 @@ class Environment(models.Model):
         cmd.file_write("%s/config/media.cnf" % self._get_nginx_root(), media)
 
         # Write uwsgi.ini file
-        uwsgi_ini = "[uwsgi]\n" \
-                    "plugins = python3\n" \
-                    "module = jorvik.wsgi:application\n" \
-                    "virtualenv = %d/.venv\n" \
-                    "chdir = %d\n" \
-                    "processes = 4\n" \
-                    "threads = 2\n" \
-                    "vacuum = True\n"
-        cmd.file_write("%s/uwsgi.ini" % self._get_nginx_root(), uwsgi_ini)
+        self.vassal_configure()
 
     def _uwsgi_touch(self):
-        cmd.bash_execute("touch uwsgi.ini", cwd=self._get_nginx_root())
+        cmd.execute(["touch", "uwsgi.ini"], cwd=self._get_nginx_root())
 
     def _database_refresh(self):
         self._database_delete()
         self._database_create()
 
-    def _django_cmd(self, command):
-        return cmd.bash_execute("DJANGO_SETTINGS_MODULE=jorvik.settings python manage.py %s" % command,
-                                cwd=self._get_nginx_root(), venv=".venv")
+    def _django_cmd(self, *args):
+        return cmd.execute(["python", "manage.py"] + list(args), cwd=self._get_nginx_root(), venv=".venv",
+                           env={"DJANGO_SETTINGS_MODULE": "jorvik.settings"})
 
-    def _postgres_cmd(self, command, user="staging", password=None, database="staging"):
-        if password:
-            command = "PGPASSWORD=%s %s" % (password, command)
-        command = "psql -U %s %s -c \"%s\"" % (user, database, command)
-        return cmd.bash_execute(command)
+    def _postgres_batch(self, statements, database="staging", transaction=True, check=True):
+        return postgres_batch(statements, database=database, transaction=transaction, check=check)
 
     def _postgres_generate_credentials(self):
         username = random_username(8)
         self.db_name = "staging_%s" % username
         self.db_user = "staging_%s" % username
         self.db_pass = random_password(24)
-        self.save()
+        self._save_fields("db_name", "db_user", "db_pass")
 
     def _postgres_stop(self):
-        cmd.bash_execute("%s %s" % (SUDO_BIN, DB_STOP_SCRIPT))
+        cmd.execute([SUDO_BIN, DB_STOP_SCRIPT])
 
     def _postgres_start(self):
-        cmd.bash_execute("%s %s" % (SUDO_BIN, DB_START_SCRIPT))
+        cmd.execute([SUDO_BIN, DB_START_SCRIPT])
 
     def _postgres_restart(self):
         self._postgres_stop()
         self._postgres_start()
 
     def _django_apply_migrations(self):
-        self._django_cmd("migrate --noinput")
+        self._django_cmd("migrate", "--noinput")
 
     def _django_collect_static(self):
-        self._django_cmd("collectstatic --noinput")
+        # Instead of collectstatic, which would trust the modification times of the shared blobs
+        unchanged, linked, stored, deleted = static_collect(
+            self._get_nginx_static(), static_sources(self._get_nginx_root()),
+            "%s/.static-manifest.json" % (self._get_nginx_root(),))
+        cmd.log("Static files: %d unchanged, %d linked to the store, %d stored, %d deleted." % (
+            unchanged, linked, stored, deleted))
 
     def _get_nginx_root(self):
         return "%s/%s" % (NGINX_ROOTS, self.name)
@@ -272,12 +730,65 @@ class Environment(models.Model):
     def _create_nginx_static(self):
         cmd.dir_create(self._get_nginx_static())
 
+    def as_dict(self):
+        return {"id": self.pk, "name": self.name, "repository": self.repository, "branch": self.branch,
+                "sha": self.sha, "deployed_sha": self.deployed_sha, "status": self.status,
+                "status_display": self.get_status_display(), "url": self.url(), "vassal": self.vassal_state,
+                "pooled": self.pooled,
+                "created": self.created.isoformat(), "updated": self.updated.isoformat()}
+
     def get_display_class(self):
         return {self.ACTIVE: "",
                 self.CREATING: "warning",
                 self.DELETING: "error danger",
                 self.UPDATING: "warning",
-                self.REFRESHING: "warning",}[self.status]
+                self.REFRESHING: "warning",
+                self.FAILED: "danger",}[self.status]
+
+
+def housekeeping():
+    """
+    Cleans up what environments no longer use. Run periodically, and shortly after operations
+    (see queue_housekeeping). A step failing is logged, and does not prevent the others.
+    """
+    steps = (Environment.updates_recover,
+             lambda: venv_evict(keep=set(Environment.objects.values_list('venv_key', flat=True))),
+             DatabaseTemplate.drop_outdated,
+             vassals_rebalance,
+             Environment.vassals_probe,
+             static_store_gc,
+             lambda: log_prune_deleted(Environment.objects.values_list('pk', flat=True)))
+    for step in steps:
+        try:
+            step()
+        except Exception:
+            print("# Housekeeping step failed:\n%s" % (traceback.format_exc(),))
+
+
+def queue_housekeeping():
+    """
+    Queues the housekeeping in HOUSEKEEPING_DELAY seconds, unless it is queued already: the
+    operations finishing in the meantime share it. The periodic one catches up on failures.
+    """
+    try:
+        if redis_client().set(HOUSEKEEPING_KEY, 1, nx=True, ex=HOUSEKEEPING_DELAY):
+            from wonderbot.celery import housekeeping_run
+            housekeeping_run.apply_async(countdown=HOUSEKEEPING_DELAY)
+    except (RedisError, OperationalError) as e:
+        print("# Could not queue the housekeeping: %s" % (e,))
+
+
+def vassals_rebalance():
+    """
+    Resizes the uWSGI workers of all the environments for the current population, only
+    rewriting the configurations which change, so that the other vassals are not reloaded.
+    """
+    environments = list(Environment.serving())
+    sizing = vassal_sizing(len(environments))
+    changed = [e.name for e in environments
+               if os.path.isdir(e._get_nginx_root()) and e.vassal_configure(sizing=sizing)]
+    if changed:
+        print("# %d processes, %d threads: %s reconfigured." % (sizing + (", ".join(changed),)))
 
 
 class AllowedRepository(models.Model):
@@ -285,3 +796,279 @@ class AllowedRepository(models.Model):
     allowed_by = models.CharField(blank=False, null=False, max_length=128)
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
+
+
+class DatabaseTemplate(models.Model):
+    """
+    A golden copy of the production dump, restored once and then cloned
+    with CREATE DATABASE ... TEMPLATE for every new environment.
+    """
+
+    # Status constants
+    BUILDING = 'building'
+    READY = 'ready'
+    FAILED = 'failed'
+    STATUS = ((BUILDING, "Building"),
+              (READY, "Ready"),
+              (FAILED, "Failed"))
+
+    # Model fields
+    name = models.CharField(blank=True, max_length=64)
+    status = models.CharField(choices=STATUS, default=BUILDING, blank=False, null=False, max_length=16)
+    # A single template per version of the dump, however many workers notice it at the same time
+    dump_signature = models.CharField(blank=False, null=False, unique=True, max_length=64)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    @property
+    def generation(self):
+        return self.pk
+
+    def __str__(self):
+        return "%s (%s)" % (self.name, self.get_status_display())
+
+    @classmethod
+    def get_current(cls):
+        """
+        Returns the most recent ready template, queueing a rebuild in the
+        background if the dump has changed since it was built.
+        Returns None if no template is ready yet.
+        """
+        cls.queue_for_build_if_outdated()
+        return cls.objects.filter(status=cls.READY).order_by('-pk').first()
+
+    @classmethod
+    def queue_for_build_if_outdated(cls):
+        template = cls._create_if_outdated()
+        if template:
+            from wonderbot.celery import database_template_build
+            database_template_build.delay(template.pk)
+        return template
+
+    @classmethod
+    def build_if_outdated(cls):
+        """
+        Like queue_for_build_if_outdated, but builds the template right away.
+        """
+        template = cls._create_if_outdated()
+        if template:
+            template.do_build()
+        return template
+
+    @classmethod
+    def _create_if_outdated(cls):
+        signature = postgres_dump_signature()
+        if not signature:
+            return None
+        try:
+            with transaction.atomic():
+                template = cls.objects.create(dump_signature=signature)
+        except IntegrityError:
+            # Built or being built already, unless it failed: then it is built again, by whoever
+            # claims it first
+            retried = cls.objects.filter(dump_signature=signature, status=cls.FAILED)\
+                .update(status=cls.BUILDING, updated=timezone.now())
+            return cls.objects.get(dump_signature=signature) if retried else None
+        template.name = "%s%s_%d" % (DB_TEMPLATE_PREFIX, datetime.date.today().strftime("%Y%m%d"), template.pk)
+        template.save()
+        return template
+
+    def do_build(self):
+        try:
+            self._postgres_build()
+        except:
+            self.status = self.FAILED
+            self.save()
+            raise
+        self.status = self.READY
+        self.save()
+        DatabaseTemplate.drop_outdated()
+
+    def _postgres_build(self):
+        postgres_batch([
+            sql_create_role_if_not_exists(DB_TEMPLATE_OWNER),
+            "DROP DATABASE IF EXISTS %s;" % (self.name,),
+            "CREATE DATABASE %s OWNER %s;" % (self.name, "staging"),
+        ], transaction=False)
+        postgres_restore(self.name)
+        # Pre-apply ownership, so that clones only need a REASSIGN OWNED
+        postgres_batch([
+            "ALTER SCHEMA public OWNER TO %s;" % (DB_TEMPLATE_OWNER,),
+            sql_alter_tables_owner(DB_TEMPLATE_OWNER),
+        ], database=self.name)
+        database_analyze(self.name)
+        # Nobody should ever connect to the template, or cloning it would fail
+        postgres_batch(["ALTER DATABASE %s WITH ALLOW_CONNECTIONS false;" % (self.name,)])
+
+    @classmethod
+    def drop_outdated(cls):
+        """
+        Drops all the templates older than the current one.
+        """
+        current = cls.objects.filter(status=cls.READY).order_by('-pk').first()
+        if not current:
+            return
+        outdated = cls.objects.filter(pk__lt=current.pk).exclude(status=cls.BUILDING)
+        for template in outdated:
+            try:
+                postgres_batch(["DROP DATABASE IF EXISTS %s;" % (template.name,)], transaction=False)
+            except PostgresError:
+                # The template is being cloned right now, it will be retried next time
+                continue
+            template.delete()
+
+
+class DatabaseMaintenance(models.Model):
+    """
+    Size statistics recorded each time a database is vacuumed.
+    """
+    database = models.CharField(blank=False, null=False, db_index=True, max_length=64)
+    size_before = models.BigIntegerField(blank=True, null=True)
+    size_after = models.BigIntegerField(blank=True, null=True)
+    duration = models.FloatField(blank=True, null=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "%s (%s)" % (self.database, self.created)
+
+
+class StageRun(models.Model):
+    """
+    Timing of a provisioning stage, as run by a pipeline.
+    """
+    environment = models.ForeignKey(Environment, blank=True, null=True, on_delete=models.SET_NULL,
+                                    related_name="stage_runs")
+    environment_name = models.CharField(blank=False, null=False, db_index=True, max_length=64)
+    operation = models.CharField(blank=False, null=False, max_length=16)
+    run = models.CharField(blank=False, null=False, db_index=True, max_length=32)
+    stage = models.CharField(blank=False, null=False, db_index=True, max_length=64)
+    started = models.DateTimeField()
+    duration = models.FloatField(blank=True, null=True)
+    exit_code = models.IntegerField(blank=True, null=True)
+    output_size = models.BigIntegerField(default=0)
+
+    class Meta:
+        ordering = ['-started']
+
+    def __str__(self):
+        return "%s %s %s (%.1fs)" % (self.environment_name, self.operation, self.stage, self.duration or 0)
+
+    @classmethod
+    def statistics(cls, window=STAGE_STATISTICS_WINDOW):
+        """
+        Returns the number of runs, p50 and p95 duration of each stage over its last `window` runs.
+        """
+        statistics = []
+        stages = cls.objects.order_by('stage').values_list('stage', flat=True).distinct()
+        for stage in stages:
+            durations = list(cls.objects.filter(stage=stage, duration__isnull=False)
+                             .values_list('duration', flat=True)[:window])
+            statistics.append({"stage": stage, "runs": len(durations),
+                               "p50": percentile(durations, 50), "p95": percentile(durations, 95)})
+        return statistics
+
+
+class Snapshot(models.Model):
+    """
+    Copy of the database of an environment, which it can be restored to. Kept as a database
+    of its own, so that both taking and restoring it are local copies.
+    """
+    CREATING = 'creating'
+    READY = 'ready'
+    DELETING = 'deleting'
+    FAILED = 'failed'
+    STATUS = ((CREATING, "Creating"),
+              (READY, "Ready"),
+              (DELETING, "Deleting"),
+              (FAILED, "Failed"))
+
+    # Name of the snapshot taken automatically right after the migrations
+    MIGRATED = "migrated"
+
+    environment = models.ForeignKey(Environment, on_delete=models.CASCADE, related_name="snapshots")
+    name = models.CharField(blank=False, null=False, max_length=64)
+    database = models.CharField(blank=False, null=False, unique=True, max_length=64)
+    sha = models.CharField(blank=True, max_length=40)
+    status = models.CharField(choices=STATUS, default=CREATING, blank=False, null=False, max_length=16)
+    automatic = models.BooleanField(default=False)
+    size = models.BigIntegerField(blank=True, null=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created']
+
+    def __str__(self):
+        return "%s of %s" % (self.name, self.environment.name)
+
+    def save(self, *args, **kwargs):
+        if not self.database:
+            self.database = "staging_snapshot_%s" % (random_username(12),)
+        super(Snapshot, self).save(*args, **kwargs)
+
+    def drop(self):
+        postgres_batch(["DROP DATABASE IF EXISTS %s;" % (self.database,)], transaction=False)
+        self.delete()
+
+    @classmethod
+    def enforce_limits(cls, environment, keep=None):
+        """
+        Drops the oldest snapshots of an environment, other than `keep`, until it has
+        at most DB_SNAPSHOTS_MAX snapshots using at most DB_SNAPSHOTS_MAX_BYTES.
+        """
+        snapshots = list(environment.snapshots.filter(status=cls.READY).order_by('created'))
+        total = sum(s.size or 0 for s in snapshots)
+        for snapshot in [s for s in snapshots if s != keep]:
+            if len(snapshots) <= DB_SNAPSHOTS_MAX and total <= DB_SNAPSHOTS_MAX_BYTES:
+                break
+            snapshot.drop()
+            snapshots.remove(snapshot)
+            total -= snapshot.size or 0
+
+
+class WebhookDelivery(models.Model):
+    """
+    A delivery of a GitHub webhook, recorded as it is received and processed in the background.
+    The delivery id is unique, so that redeliveries are ignored.
+    """
+    delivery = models.CharField(unique=True, max_length=64)
+    event = models.CharField(max_length=32)
+    payload = models.TextField()
+    result = models.TextField(blank=True)
+    received = models.DateTimeField(auto_now_add=True, db_index=True)
+    started = models.DateTimeField(blank=True, null=True)
+    processed = models.DateTimeField(blank=True, null=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+
+    def __str__(self):
+        return "%s (%s)" % (self.delivery, self.event)
+
+    def queue_for_processing(self):
+        from wonderbot.celery import github_event
+        github_event.delay(self.pk)
+
+    @classmethod
+    def requeue_stale(cls):
+        """
+        Queues again the deliveries still not processed after WEBHOOK_REQUEUE_AFTER seconds,
+        e.g. because the broker was unavailable when they were received, or their processing
+        failed or was lost with its worker.
+        """
+        now = timezone.now()
+        stale = now - datetime.timedelta(seconds=WEBHOOK_REQUEUE_AFTER)
+        for delivery in cls.objects.filter(cls.q_claimable(now), received__lt=stale):
+            delivery.queue_for_processing()
+
+    @classmethod
+    def q_claimable(cls, now):
+        """
+        Deliveries not processed yet and not being processed, or not any more.
+        """
+        lost = now - datetime.timedelta(seconds=WEBHOOK_CLAIM_TIMEOUT)
+        return Q(processed__isnull=True, attempts__lt=WEBHOOK_ATTEMPTS) & \
+            (Q(started__isnull=True) | Q(started__lt=lost))
+
+    @classmethod
+    def prune(cls):
+        oldest = timezone.now() - datetime.timedelta(seconds=WEBHOOK_DELIVERIES_KEPT)
+        # Including the ones given up after WEBHOOK_ATTEMPTS, nobody is retrying them
+        cls.objects.filter(received__lt=oldest).delete()
@@ -0,0 +1,41 @@
+import contextlib
+import time
+
+from redis.exceptions import RedisError
+
+from staging.locks import redis_client
+
+ENVIRONMENTS_CHANNEL = "wonderbot:environments"
+
+
+def notify_environment_changed(environment_id):
+    """
+    Tells the dashboards waiting for changes that an environment has changed.
+    Never fails: at worst, dashboards notice on their next poll.
+    """
+    try:
+        redis_client().publish(ENVIRONMENTS_CHANNEL, environment_id)
+    except RedisError as e:
+        print("# Could not notify change of environment %s: %s" % (environment_id, e))
+
+
+@contextlib.contextmanager
+def environment_changes():
+    """
+    Subscribes to environment changes. Yields a function waiting up to `timeout`
+    seconds for a change, and returning whether there was one.
+    """
+    pubsub = redis_client().pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(ENVIRONMENTS_CHANNEL)
+
+    def wait(timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if pubsub.get_message(timeout=deadline - time.time()):
+                return True
+        return False
+
+    try:
+        yield wait
+    finally:
+        pubsub.close()
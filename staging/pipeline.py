@@ -0,0 +1,196 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from django.db import connection
+from django.utils import timezone
+
+import staging.cmd as cmd
+from staging.logs import RunLog
+from wonderbot.settings import PIPELINE_WORKERS, PIPELINE_POLL_INTERVAL
+
+
+class PipelineCancelled(Exception):
+    pass
+
+
+class StageFailed(Exception):
+    """
+    Raised by a pipeline when one of its stages fails.
+    """
+
+    def __init__(self, stage, error):
+        self.stage = stage
+        self.error = error
+        super(StageFailed, self).__init__("Stage %s failed: %s" % (stage, error))
+
+
+class Stage(object):
+    """
+    A named provisioning step, run by calling the environment method of the
+    same name (prefixed by an underscore) once all the stages it requires are done.
+    """
+
+    def __init__(self, name, requires=()):
+        self.name = name
+        self.requires = tuple(requires)
+
+    def __repr__(self):
+        return "Stage(%r)" % (self.name,)
+
+
+class Pipeline(object):
+    """
+    A graph of stages. Stages whose requirements are satisfied run in parallel,
+    so the total time is the one of the critical path.
+    """
+
+    def __init__(self, *stages):
+        self.stages = list(stages)
+        names = [stage.name for stage in self.stages]
+        for stage in self.stages:
+            missing = set(stage.requires) - set(names)
+            if missing:
+                raise ValueError("Stage %s requires unknown stages %s" % (stage.name, ", ".join(missing)))
+        self._check_acyclic()
+
+    def _check_acyclic(self):
+        done = set()
+        remaining = list(self.stages)
+        while remaining:
+            ready = [stage for stage in remaining if set(stage.requires) <= done]
+            if not ready:
+                raise ValueError("Cycle between stages %s" % ", ".join(s.name for s in remaining))
+            done |= set(stage.name for stage in ready)
+            remaining = [stage for stage in remaining if stage not in ready]
+
+    def then(self, other):
+        """
+        Returns a pipeline running all of this pipeline's stages before the ones of `other`.
+        """
+        names = [stage.name for stage in self.stages]
+        return Pipeline(*(self.stages + [Stage(stage.name, stage.requires or names)
+                                         for stage in other.stages]))
+
+    def run(self, environment, operation, cancelled=None, workers=PIPELINE_WORKERS):
+        """
+        Runs all the stages on an environment, recording their timings under a new run of `operation`.
+        If a stage fails, no further stage is started, the commands of the running ones are killed
+        and the first exception is raised. Likewise, PipelineCancelled is raised as soon as
+        `cancelled()` becomes true.
+        """
+        run = uuid.uuid4().hex
+        # Set to kill the commands still running as soon as the pipeline fails or is cancelled
+        abort = threading.Event()
+        log = RunLog(environment.pk, run)
+        log.write("# %s of %s\n" % (operation.capitalize(), environment.name))
+        done, running, errors = set(), {}, []
+        pending = list(self.stages)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while running or (pending and not errors):
+                if not errors and cancelled and cancelled():
+                    errors.append(PipelineCancelled())
+                if not errors:
+                    for stage in [s for s in pending if set(s.requires) <= done]:
+                        pending.remove(stage)
+                        running[executor.submit(self._run_stage, environment, stage, operation, log,
+                                                abort.is_set)] = stage
+                if errors:
+                    abort.set()
+                finished, _ = wait(running, timeout=PIPELINE_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    if future.exception():
+                        errors.append(StageFailed(stage.name, future.exception()))
+                        abort.set()
+                    else:
+                        done.add(stage.name)
+        log.write("# %s\n" % ("; ".join(str(e) or "Cancelled" for e in errors) if errors else "Done"))
+        log.close()
+        if errors:
+            error = errors[0]
+            raise error from getattr(error, "error", None)
+
+    def _run_stage(self, environment, stage, operation, log, aborted):
+        from staging.models import StageRun
+        record = StageRun(environment=environment, environment_name=environment.name,
+                          operation=operation, run=log.run, stage=stage.name, started=timezone.now())
+        started = time.time()
+        try:
+            with cmd.recording() as recording, cmd.logging_to(log, "[%s] " % (stage.name,)), \
+                    cmd.cancellable(aborted):
+                try:
+                    getattr(environment, "_%s" % (stage.name,))()
+                finally:
+                    record.exit_code = recording.exit_code
+                    record.output_size = recording.output_size
+        except:
+            record.exit_code = record.exit_code or -1
+            raise
+        finally:
+            record.duration = time.time() - started
+            record.save()
+            # Each thread gets its own database connection
+            connection.close()
+
+
+CREATION = Pipeline(
+    Stage("git_clone"),
+    Stage("python_venv_setup", requires=["git_clone"]),
+    Stage("database_create"),
+    Stage("jorvik_configure", requires=["git_clone", "database_create"]),
+    Stage("django_apply_migrations", requires=["jorvik_configure", "python_venv_setup"]),
+    Stage("django_collect_static", requires=["jorvik_configure", "python_venv_setup"]),
+    Stage("uwsgi_touch", requires=["django_apply_migrations", "django_collect_static"]),
+)
+
+REFRESH = Pipeline(
+    Stage("database_refresh"),
+    Stage("jorvik_configure", requires=["database_refresh"]),
+    Stage("django_apply_migrations", requires=["jorvik_configure"]),
+    Stage("uwsgi_touch", requires=["django_apply_migrations"]),
+)
+
+UPDATE = Pipeline(
+    Stage("git_pull_latest"),
+    Stage("python_venv_update", requires=["git_pull_latest"]),
+    Stage("django_collect_static", requires=["python_venv_update"]),
+    Stage("database_refresh"),
+    Stage("jorvik_configure", requires=["git_pull_latest", "database_refresh"]),
+    Stage("django_apply_migrations", requires=["jorvik_configure", "python_venv_update"]),
+    Stage("uwsgi_touch", requires=["django_apply_migrations", "django_collect_static"]),
+)
+
+DELETION = Pipeline(
+    Stage("nginx_delete"),
+    # The user of the environment can only be dropped once no snapshot refers to it
+    Stage("snapshots_delete"),
+    Stage("database_delete", requires=["snapshots_delete"]),
+)
+
+RECREATION = DELETION.then(CREATION)
+
+
+def incremental_update(changes):
+    """
+    Returns the pipeline updating an environment to a commit which made the given
+    changes, running only the stages these changes require.
+    """
+    stages = [Stage("git_pull")]
+    code = ["git_pull"]
+    if changes.requirements:
+        stages.append(Stage("python_venv_update", requires=["git_pull"]))
+        code.append("python_venv_update")
+    if changes.static or changes.requirements:
+        # New dependencies may come with their own static files
+        stages.append(Stage("django_collect_static", requires=code))
+    if changes.migrations_rewritten:
+        # The migrations applied to the database are no longer valid
+        stages += [Stage("database_refresh"),
+                   Stage("jorvik_configure", requires=["git_pull", "database_refresh"]),
+                   Stage("django_apply_migrations", requires=code + ["jorvik_configure"])]
+    elif changes.migrations_added:
+        stages.append(Stage("django_apply_migrations", requires=code))
+    stages.append(Stage("uwsgi_touch", requires=[stage.name for stage in stages]))
+    return Pipeline(*stages)
@@ -0,0 +1,148 @@
+import os
+import re
+
+import staging.cmd as cmd
+from staging.scheduler import restore_workers
+from wonderbot.settings import DB_DUMP_FILENAME
+
+
+RESTORE_ERRORS_IGNORED = re.compile(r"^WARNING: errors ignored on restore: (\d+)$", re.MULTILINE)
+RESTORE_FATAL = re.compile(r"could not open input file|connection to database .* failed|"
+                           r"worker process died|out of memory|No space left on device", re.IGNORECASE)
+
+
+class PostgresError(Exception):
+    """
+    Raised when a statement in a batch fails. Carries the failing statement.
+    """
+
+    def __init__(self, statement, message):
+        self.statement = statement
+        self.message = message
+        super(PostgresError, self).__init__("%s\nin statement: %s" % (message, statement))
+
+
+def postgres_batch(statements, database="staging", user="staging", password=None, transaction=True, check=True):
+    """
+    Runs a list of SQL statements in a single psql session, i.e. over a single
+    connection and with a single round-trip.
+
+    :param transaction: Run the whole batch in a single transaction. Must be False for
+                        statements which cannot run in a transaction block (e.g. CREATE DATABASE).
+    :param check: Raise PostgresError with the failing statement if the batch fails.
+    :return: The return code of psql.
+    """
+    script, lines = "", []
+    for index, statement in enumerate(statements):
+        statement = statement.strip()
+        script += statement + "\n"
+        lines += [index] * (statement.count("\n") + 1)
+
+    argv = ["psql", "-X", "-q", "-v", "ON_ERROR_STOP=1", "-U", user, database]
+    if transaction:
+        argv.append("--single-transaction")
+    env = {"PGPASSWORD": password} if password else None
+    result = cmd.execute(argv, input=script, env=env, check=False, capture=True)
+    code, errors = result.returncode, result.err
+
+    if code and check:
+        # psql reports the failing line as "psql:<stdin>:LINE: ERROR: ..."
+        match = re.search(r"^psql:<stdin>:(\d+): (.*)$", errors, re.MULTILINE)
+        if match and 0 < int(match.group(1)) <= len(lines):
+            statement = statements[lines[int(match.group(1)) - 1]]
+            raise PostgresError(statement.strip(), match.group(2))
+        raise PostgresError(script.strip(), errors.strip() or "psql exited with code %d" % code)
+    return code
+
+
+def postgres_query(query, database="staging", user="staging"):
+    """
+    Runs a single query and returns its result as a list of tuples of strings.
+    """
+    argv = ["psql", "-X", "-q", "-A", "-t", "-F", "|", "-v", "ON_ERROR_STOP=1", "-U", user, database]
+    result = cmd.execute(argv, input=query, check=False, capture=True)
+    if result.returncode:
+        raise PostgresError(query, result.err.strip() or "psql exited with code %d" % result.returncode)
+    return [tuple(line.split("|")) for line in result.out.splitlines() if line]
+
+
+def postgres_database_size(database):
+    rows = postgres_query("SELECT pg_database_size('%s');" % (database,))
+    return int(rows[0][0]) if rows else None
+
+
+def postgres_restore(database, filename=DB_DUMP_FILENAME, user="staging", workers=None):
+    """
+    Restores the dump into an existing database. Errors reported by pg_restore about single
+    objects (e.g. the owner of an extension) do not fail the restore, as long as it runs to
+    the end, but anything else does (e.g. a missing dump, a connection failure, a timeout),
+    raising CommandError. By default, the number of parallel jobs depends on the current load.
+    Returns the number of errors ignored.
+    """
+    from staging.dumps import dump_reading
+    if workers is None:
+        workers = restore_workers()
+    # The format, custom or directory, is detected by pg_restore
+    with dump_reading(filename) as path:
+        result = cmd.execute(["pg_restore", "-d", database, "-U", user, "-j", workers,
+                              "--no-owner", "--no-privileges", path], kind="pg_restore", check=False, capture=True)
+    if not result.returncode:
+        return 0
+    # Only printed when pg_restore carried on until the end
+    ignored = RESTORE_ERRORS_IGNORED.search(result.err)
+    if result.returncode < 0 or not ignored or RESTORE_FATAL.search(result.err):
+        raise cmd.CommandError(result.argv, result.returncode, result.err[-4096:])
+    cmd.log("pg_restore: %s errors ignored." % (ignored.group(1),))
+    return int(ignored.group(1))
+
+
+def sql_create_role_if_not_exists(role):
+    return "DO $$BEGIN\n" \
+           "  IF NOT EXISTS (SELECT 1 FROM pg_roles WHERE rolname = '%(role)s') THEN\n" \
+           "    CREATE ROLE %(role)s NOLOGIN;\n" \
+           "  END IF;\n" \
+           "END$$;" % {"role": role}
+
+
+def sql_alter_tables_owner(owner):
+    """
+    Returns a DO block which changes the owner of each of the tables outside
+    of the system schemas, server-side.
+    """
+    return "DO $$DECLARE r record;\n" \
+           "BEGIN\n" \
+           "  FOR r IN SELECT schemaname, tablename FROM pg_tables\n" \
+           "           WHERE NOT schemaname IN ('pg_catalog', 'information_schema')\n" \
+           "           ORDER BY schemaname, tablename LOOP\n" \
+           "    EXECUTE format('ALTER TABLE %%I.%%I OWNER TO %%I', r.schemaname, r.tablename, '%(owner)s');\n" \
+           "  END LOOP;\n" \
+           "END$$;" % {"owner": owner}
+
+
+def sql_terminate_connections(database):
+    """
+    Returns the statements which block new connections to a database and
+    terminate its existing backends, without affecting other databases.
+    """
+    return ["DO $$BEGIN\n"
+            "  IF EXISTS (SELECT 1 FROM pg_database WHERE datname = '%(database)s') THEN\n"
+            "    ALTER DATABASE %(database)s WITH ALLOW_CONNECTIONS false;\n"
+            "  END IF;\n"
+            "END$$;" % {"database": database},
+            "SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+            "WHERE datname = '%s' AND pid <> pg_backend_pid();" % (database,)]
+
+
+def postgres_dump_signature(filename=DB_DUMP_FILENAME):
+    """
+    Returns a string identifying the current version of the database dump,
+    or None if no dump is available.
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    if os.path.islink(filename):
+        # Ingested dump, see staging.dumps
+        return "generation-%s" % (os.path.basename(os.path.dirname(os.readlink(filename))),)
+    return "%d-%d" % (stat.st_mtime, stat.st_size)
@@ -0,0 +1,97 @@
+import os
+import re
+import time
+
+import staging.cmd as cmd
+from staging.utils import file_lock
+from wonderbot.settings import GIT_MIRRORS_PATH
+
+
+def mirror_path(url):
+    """
+    Returns the path of the local bare mirror of a repository.
+    """
+    return "%s/%s" % (GIT_MIRRORS_PATH, re.sub(r"[^A-Za-z0-9._-]+", "_", url))
+
+
+def mirror_lock(url):
+    """
+    Serialises operations on a mirror across worker processes.
+    """
+    os.makedirs(GIT_MIRRORS_PATH, exist_ok=True)
+    return file_lock("%s.lock" % mirror_path(url))
+
+
+def mirror_git(url, *args, **kwargs):
+    return cmd.execute(["git", "--git-dir=%s" % (mirror_path(url),)] + list(args), **kwargs)
+
+
+def mirror_has_commit(url, sha):
+    return mirror_git(url, "cat-file", "-e", "%s^{commit}" % (sha,), check=False).returncode == 0
+
+
+def mirror_fetch(url, sha=None, max_age=None):
+    """
+    Creates or updates the local mirror of a repository. If `sha` is given and
+    the mirror already contains it, GitHub is not contacted at all, so that a
+    push is only fetched once regardless of how many environments track it.
+    Likewise if the mirror was fetched less than `max_age` seconds ago.
+    """
+    fetched = "%s.fetched" % mirror_path(url)
+    with mirror_lock(url):
+        if not os.path.isdir(mirror_path(url)):
+            cmd.execute(["git", "clone", "--mirror", url, mirror_path(url)], kind="git")
+        elif sha and mirror_has_commit(url, sha):
+            return
+        elif max_age and os.path.exists(fetched) and time.time() - os.path.getmtime(fetched) < max_age:
+            return
+        else:
+            mirror_git(url, "remote", "update", "--prune", kind="git")
+        cmd.file_write(fetched, url)
+
+
+def mirror_resolve(url, branch):
+    """
+    Returns the sha of the head of a branch in the mirror, or None.
+    """
+    result = mirror_git(url, "rev-parse", "--verify", "-q", "refs/heads/%s" % (branch,), check=False, capture=True)
+    return result.out.strip() if result.returncode == 0 else None
+
+
+def mirror_diff(url, old, new):
+    """
+    Returns the `git diff --name-status` output between two commits of the mirror, or None.
+    """
+    result = mirror_git(url, "diff", "--name-status", "-M", old, new, check=False, capture=True)
+    return result.out if result.returncode == 0 else None
+
+
+def worktree_add(url, path, sha):
+    """
+    Checks out a commit of the mirror in a new working tree at `path`.
+    """
+    with mirror_lock(url):
+        mirror_git(url, "worktree", "prune")
+        return mirror_git(url, "worktree", "add", "--detach", path, sha)
+
+
+def worktree_move(url, path, new_path):
+    """
+    Moves a working tree of the mirror, along with its untracked files.
+    """
+    with mirror_lock(url):
+        return mirror_git(url, "worktree", "move", path, new_path)
+
+
+def worktree_checkout(path, sha):
+    return cmd.execute(["git", "checkout", "-q", "-f", "--detach", sha], cwd=path)
+
+
+def worktree_prune(url):
+    """
+    Forgets about working trees which have been deleted.
+    """
+    if not os.path.isdir(mirror_path(url)):
+        return
+    with mirror_lock(url):
+        return mirror_git(url, "worktree", "prune")
@@ -0,0 +1,87 @@
+import os
+
+from wonderbot.settings import SCHEDULER_MAX_LOAD, SCHEDULER_MAX_IO_PRESSURE, SCHEDULER_MIN_MEMORY, \
+    DB_DUMP_WORKERS
+
+
+def cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _meminfo(field):
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("%s:" % (field,)):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def memory_available():
+    """
+    Bytes of memory available without swapping, or None if unknown.
+    """
+    return _meminfo("MemAvailable")
+
+
+def memory_total():
+    return _meminfo("MemTotal")
+
+
+def io_pressure():
+    """
+    Percentage of the last 10 seconds some task was stalled on I/O (Linux pressure
+    stall information), or None if not available.
+    """
+    try:
+        with open("/proc/pressure/io") as f:
+            for line in f:
+                if line.startswith("some"):
+                    return float(dict(field.split("=") for field in line.split()[1:])["avg10"])
+    except (OSError, KeyError, ValueError):
+        pass
+    return None
+
+
+def load():
+    """
+    The 1-minute load average, per core.
+    """
+    return os.getloadavg()[0] / cpu_count()
+
+
+def admit(priority):
+    """
+    Returns None if an operation of the given priority ("create", "update" or "background")
+    can start now, otherwise the reason why not. Less urgent operations have smaller budgets,
+    so they are the first to give way as the machine gets busy. Anything else, e.g.
+    deletions, is always admitted.
+    """
+    if priority not in SCHEDULER_MAX_LOAD:
+        return None
+    if load() > SCHEDULER_MAX_LOAD[priority]:
+        return "load %.2f per core" % (load(),)
+    pressure = io_pressure()
+    if pressure is not None and pressure > SCHEDULER_MAX_IO_PRESSURE[priority]:
+        return "I/O pressure %.0f%%" % (pressure,)
+    memory = memory_available()
+    if memory is not None and memory < SCHEDULER_MIN_MEMORY:
+        return "%d MB of memory available" % (memory // 1024 ** 2,)
+    return None
+
+
+def restore_workers(maximum=DB_DUMP_WORKERS):
+    """
+    Number of parallel jobs for a pg_restore: the idle cores, at least one and at most
+    `maximum`, and half as many if the disk is already busy.
+    """
+    workers = int(cpu_count() - os.getloadavg()[0])
+    pressure = io_pressure()
+    if pressure is not None and pressure > SCHEDULER_MAX_IO_PRESSURE["background"]:
+        workers //= 2
+    return max(1, min(maximum, workers))
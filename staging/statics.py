@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+import shutil
+
+import staging.cmd as cmd
+from wonderbot.settings import STATIC_STORE_PATH
+
+# Lists the static files of a project as collectstatic finds them: {path: source}, the first
+# source found for a path wins. Run with the project's own interpreter and settings.
+STATIC_SOURCES_SCRIPT = """
+import json, os, django
+django.setup()
+from django.contrib.staticfiles.finders import get_finders
+found = {}
+for finder in get_finders():
+    for path, storage in finder.list(["CVS", ".*", "*~"]):
+        prefixed = os.path.join(getattr(storage, "prefix", None) or "", path)
+        found.setdefault(prefixed, os.path.realpath(storage.path(path)))
+print(json.dumps(found))
+"""
+
+
+def static_blob_path(digest):
+    return "%s/%s/%s" % (STATIC_STORE_PATH, digest[:2], digest[2:])
+
+
+def static_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 ** 2), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _static_link(path, blob):
+    """
+    Makes `path` and `blob` the same file. Returns True if `path` became the blob.
+    """
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    try:
+        os.link(path, blob)
+        return True
+    except FileExistsError:
+        pass
+    temporary = "%s.wonderbot" % (path,)
+    try:
+        os.link(blob, temporary)
+    except FileNotFoundError:
+        # Collected in the meantime
+        return _static_link(path, blob)
+    os.replace(temporary, path)
+    return False
+
+
+def static_sources(root, venv=".venv", settings="jorvik.settings"):
+    """
+    Returns the static files of the project in `root`, as {path in STATIC_ROOT: source}.
+    """
+    result = cmd.execute(["python", "-c", STATIC_SOURCES_SCRIPT], cwd=root, venv=venv,
+                         env={"DJANGO_SETTINGS_MODULE": settings}, capture=True)
+    # Anything printed while loading the settings comes before
+    return json.loads(result.out.strip().splitlines()[-1])
+
+
+def static_collect(directory, sources, manifest):
+    """
+    Collects the static files `sources` (see static_sources) in `directory`, as hardlinks to
+    the shared store. What changed is told by the content of the sources, not by modification
+    times, which mean nothing for blobs shared by all environments: the digest of each source
+    is recorded in the `manifest` file, and only computed again when the source changes
+    (path, size or modification time). Files whose digest did not change are left untouched,
+    so the environment keeps serving them while it is updated. Files no longer found are deleted.
+    Returns a tuple (files unchanged, linked to an existing blob, stored, deleted).
+    """
+    try:
+        with open(manifest, "rt") as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        previous = {}
+    current, counts = {}, [0, 0, 0, 0]
+    for path, source in sorted(sources.items()):
+        stat = os.stat(source)
+        entry = [source, stat.st_size, stat.st_mtime_ns]
+        target = os.path.join(directory, path)
+        old = previous.get(path)
+        if old and old[:3] == entry:
+            digest = old[3]
+        else:
+            digest = static_digest(source)
+        current[path] = entry + [digest]
+        if old and old[3] == digest and os.path.isfile(target):
+            counts[0] += 1
+            continue
+        counts[2 if _static_install(source, target, static_blob_path(digest)) else 1] += 1
+
+    for path in set(previous) - set(current):
+        try:
+            os.remove(os.path.join(directory, path))
+            counts[3] += 1
+        except FileNotFoundError:
+            pass
+
+    temporary = "%s.wonderbot" % (manifest,)
+    with open(temporary, "wt") as f:
+        json.dump(current, f)
+    os.replace(temporary, manifest)
+    return tuple(counts)
+
+
+def _static_install(source, target, blob):
+    """
+    Replaces `target` with a link to `blob`, storing the contents of `source` as the
+    blob first if needed. Returns True if the blob was stored.
+    """
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    temporary = "%s.wonderbot-new" % (target,)
+    if os.path.lexists(temporary):
+        # Left by an interrupted collection
+        os.remove(temporary)
+    stored = False
+    try:
+        os.link(blob, temporary)
+    except FileNotFoundError:
+        shutil.copyfile(source, temporary)
+        stored = _static_link(temporary, blob)
+    # Atomically, the previous version is served until then
+    os.replace(temporary, target)
+    return stored
+
+
+def static_store_gc():
+    """
+    Deletes the blobs no environment links to anymore. Returns how many were deleted.
+    """
+    deleted = 0
+    if not os.path.isdir(STATIC_STORE_PATH):
+        return deleted
+    for root, _, files in os.walk(STATIC_STORE_PATH):
+        for filename in files:
+            path = os.path.join(root, filename)
+            if os.lstat(path).st_nlink == 1:
+                os.remove(path)
+                deleted += 1
+    return deleted
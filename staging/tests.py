@@ -1,3 +1,498 @@
-from django.test import TestCase
+import datetime
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+import staging.cmd as cmd
+import staging.statics as statics
+import staging.vassals as vassals
+import staging.webhooks as webhooks
+from staging.changes import Changes
+from staging.github import StatusReporter
+from staging.locks import lock_kept
+from staging.maintenance import in_maintenance_window
+from staging.venvs import venv_ensure
+from staging.models import DatabaseTemplate, Environment, WebhookDelivery, housekeeping
+from staging.pipeline import CREATION, DELETION, RECREATION, Pipeline, Stage, incremental_update
+from wonderbot.settings import DEFAULT_REPOSITORY_URL, NGINX_ROOTS
+
+SECRET = "s3cret"
+
+
+def _signature(body, secret=SECRET, algorithm="sha256"):
+    return "%s=%s" % (algorithm, hmac.new(secret.encode("utf-8"), body, getattr(hashlib, algorithm)).hexdigest())
+
+
+class WebhookTestCase(TestCase):
+
+    def setUp(self):
+        handle, path = tempfile.mkstemp()
+        with os.fdopen(handle, "wt") as f:
+            f.write("%s\n" % (SECRET,))
+        self.addCleanup(os.remove, path)
+        patcher = mock.patch.object(webhooks, "GITHUB_WEBHOOK_SECRET_FILE", path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        webhooks._secret = (None, None)
+
+    def _post(self, body, delivery="d-1", event="ping", signature=None, header="HTTP_X_HUB_SIGNATURE_256"):
+        extra = {"HTTP_X_GITHUB_DELIVERY": delivery, "HTTP_X_GITHUB_EVENT": event}
+        if signature:
+            extra[header] = signature
+        return self.client.post("/hook/", data=body, content_type="application/json", **extra)
+
+
+class WebhookSignatureTest(WebhookTestCase):
+
+    body = b'{"zen": "Keep it logically awesome."}'
+
+    def test_valid(self):
+        self.assertTrue(webhooks.webhook_signature_valid(self.body, _signature(self.body)))
+        self.assertTrue(webhooks.webhook_signature_valid(self.body, _signature(self.body, algorithm="sha1")))
+
+    def test_invalid(self):
+        self.assertFalse(webhooks.webhook_signature_valid(self.body, _signature(self.body, secret="other")))
+        self.assertFalse(webhooks.webhook_signature_valid(self.body + b" ", _signature(self.body)))
+        self.assertFalse(webhooks.webhook_signature_valid(self.body, _signature(self.body, algorithm="md5")))
+        self.assertFalse(webhooks.webhook_signature_valid(self.body, "garbage"))
+
+    def test_missing(self):
+        self.assertFalse(webhooks.webhook_signature_valid(self.body, None))
+        self.assertFalse(webhooks.webhook_signature_valid(self.body, ""))
+
+    def test_no_secret(self):
+        with mock.patch.object(webhooks, "GITHUB_WEBHOOK_SECRET_FILE", "/nonexistent/secret"):
+            webhooks._secret = (None, None)
+            self.assertFalse(webhooks.webhook_signature_valid(self.body, _signature(self.body)))
+
+    def test_hook_rejects_unsigned(self):
+        with mock.patch.object(WebhookDelivery, "queue_for_processing") as queue:
+            self.assertEqual(self._post(self.body).status_code, 403)
+            self.assertEqual(self._post(self.body, signature=_signature(self.body, secret="other")).status_code, 403)
+        queue.assert_not_called()
+        self.assertFalse(WebhookDelivery.objects.exists())
+
+    def test_hook_accepts_signed(self):
+        with mock.patch.object(WebhookDelivery, "queue_for_processing") as queue:
+            response = self._post(self.body, signature=_signature(self.body, algorithm="sha1"),
+                                  header="HTTP_X_HUB_SIGNATURE")
+        self.assertEqual(response.status_code, 202)
+        queue.assert_called_once_with()
+        self.assertEqual(WebhookDelivery.objects.get().event, "ping")
+
+
+class WebhookDeliveryTest(WebhookTestCase):
+
+    body = json.dumps({"zen": "Design for failure."}).encode("utf-8")
+
+    def test_duplicate_not_queued(self):
+        with mock.patch.object(WebhookDelivery, "queue_for_processing") as queue:
+            first = self._post(self.body, signature=_signature(self.body))
+            second = self._post(self.body, signature=_signature(self.body))
+        self.assertEqual(first.status_code, 202)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(queue.call_count, 1)
+        self.assertEqual(WebhookDelivery.objects.count(), 1)
+
+    def test_queued_twice_processed_once(self):
+        delivery = WebhookDelivery.objects.create(delivery="d-1", event="ping", payload="{}")
+        with mock.patch.object(webhooks, "webhook_route", return_value="Done.") as route:
+            webhooks.webhook_deliver(delivery.pk)
+            webhooks.webhook_deliver(delivery.pk)
+        route.assert_called_once_with("ping", {})
+        delivery.refresh_from_db()
+        self.assertIsNotNone(delivery.processed)
+        self.assertEqual((delivery.attempts, delivery.result), (1, "Done."))
+
+    def test_failure_retried(self):
+        delivery = WebhookDelivery.objects.create(delivery="d-1", event="ping", payload="{}")
+        with mock.patch.object(webhooks, "webhook_route", side_effect=RuntimeError("down")):
+            with self.assertRaises(RuntimeError):
+                webhooks.webhook_deliver(delivery.pk)
+        delivery.refresh_from_db()
+        self.assertIsNone(delivery.processed)
+        self.assertIsNone(delivery.started)
+        self.assertIn("down", delivery.result)
+
+        # Picked up again once stale
+        WebhookDelivery.objects.filter(pk=delivery.pk)\
+            .update(received=timezone.now() - datetime.timedelta(hours=1))
+        with mock.patch.object(WebhookDelivery, "queue_for_processing") as queue:
+            WebhookDelivery.requeue_stale()
+        queue.assert_called_once_with()
+
+        with mock.patch.object(webhooks, "webhook_route", return_value="Done."):
+            webhooks.webhook_deliver(delivery.pk)
+        delivery.refresh_from_db()
+        self.assertIsNotNone(delivery.processed)
+        self.assertEqual(delivery.attempts, 2)
+
+    def test_processing_not_requeued(self):
+        long_ago = timezone.now() - datetime.timedelta(hours=1)
+        WebhookDelivery.objects.create(delivery="d-1", event="ping", payload="{}")
+        WebhookDelivery.objects.update(received=long_ago, started=timezone.now())
+        with mock.patch.object(WebhookDelivery, "queue_for_processing") as queue:
+            WebhookDelivery.requeue_stale()
+        queue.assert_not_called()
+
+
+class ChangesTest(SimpleTestCase):
+
+    def test_code_only(self):
+        changes = Changes("M\tanagrafica/views.py\nA\tanagrafica/forms.py\n")
+        self.assertEqual(len(changes.files), 2)
+        self.assertFalse(changes.requirements or changes.static or changes.migrations_added
+                         or changes.migrations_rewritten)
+
+    def test_requirements_and_static(self):
+        changes = Changes("M\trequirements.txt\nA\tbase/static/js/app.js\n")
+        self.assertTrue(changes.requirements)
+        self.assertTrue(changes.static)
+        self.assertFalse(Changes("M\tdocs/requirements.txt\n").requirements)
+
+    def test_migrations_added(self):
+        changes = Changes("A\tanagrafica/migrations/0042_persona_email.py\n")
+        self.assertTrue(changes.migrations_added)
+        self.assertFalse(changes.migrations_rewritten)
+        self.assertFalse(Changes("A\tanagrafica/migrations/__init__.py\n").migrations_added)
+
+    def test_migrations_rewritten(self):
+        for line in ("M\tanagrafica/migrations/0001_initial.py",
+                     "D\tanagrafica/migrations/0002_auto.py",
+                     "R100\tanagrafica/migrations/0003_a.py\tanagrafica/migrations/0003_b.py"):
+            self.assertTrue(Changes(line).migrations_rewritten, line)
+
+    def test_rename_lists_both_paths(self):
+        changes = Changes("R087\tbase/static/a.css\tbase/b.css\n\nbogus\n")
+        self.assertEqual(changes.files, [("R", "base/static/a.css"), ("R", "base/b.css")])
+        self.assertTrue(changes.static)
+
+
+class PipelineTest(SimpleTestCase):
+
+    def test_unknown_stage(self):
+        with self.assertRaisesRegex(ValueError, "unknown stages b"):
+            Pipeline(Stage("a", requires=["b"]))
+
+    def test_cycle(self):
+        with self.assertRaisesRegex(ValueError, "Cycle"):
+            Pipeline(Stage("a"), Stage("b", requires=["a", "c"]), Stage("c", requires=["b"]))
+        with self.assertRaisesRegex(ValueError, "Cycle"):
+            Pipeline(Stage("a", requires=["a"]))
+
+    def test_then(self):
+        first = Pipeline(Stage("a"), Stage("b"))
+        both = first.then(Pipeline(Stage("c"), Stage("d", requires=["c"])))
+        requires = {stage.name: set(stage.requires) for stage in both.stages}
+        self.assertEqual(requires, {"a": set(), "b": set(), "c": {"a", "b"}, "d": {"c"}})
+
+    def test_recreation_deletes_first(self):
+        deletion = set(stage.name for stage in DELETION.stages)
+        creation = RECREATION.stages[len(DELETION.stages):]
+        self.assertEqual([stage.name for stage in creation], [stage.name for stage in CREATION.stages])
+        # The stages of the creation without requirements wait for the whole deletion
+        for stage, original in zip(creation, CREATION.stages):
+            self.assertEqual(set(stage.requires), set(original.requires) or deletion, stage)
+
+    def _stages(self, diff):
+        return {stage.name: set(stage.requires) for stage in incremental_update(Changes(diff)).stages}
+
+    def test_incremental_code_only(self):
+        self.assertEqual(self._stages("M\tanagrafica/views.py"),
+                         {"git_pull": set(), "uwsgi_touch": {"git_pull"}})
+
+    def test_incremental_requirements(self):
+        stages = self._stages("M\trequirements.txt")
+        self.assertEqual(stages["python_venv_update"], {"git_pull"})
+        self.assertEqual(stages["django_collect_static"], {"git_pull", "python_venv_update"})
+        self.assertNotIn("django_apply_migrations", stages)
+
+    def test_incremental_migrations(self):
+        stages = self._stages("A\tanagrafica/migrations/0042_persona_email.py")
+        self.assertEqual(stages["django_apply_migrations"], {"git_pull"})
+        self.assertNotIn("database_refresh", stages)
+        stages = self._stages("M\tanagrafica/migrations/0001_initial.py")
+        self.assertEqual(stages["django_apply_migrations"], {"git_pull", "jorvik_configure"})
+        self.assertEqual(stages["jorvik_configure"], {"git_pull", "database_refresh"})
+        self.assertEqual(stages["uwsgi_touch"], set(stages) - {"uwsgi_touch"})
+
+
+@mock.patch("staging.models.notify_environment_changed")
+class PoolClaimTest(TestCase):
+
+    def setUp(self):
+        Environment.objects.create(name="pool-abc", pooled=True, status=Environment.ACTIVE)
+
+    def _claim(self):
+        with mock.patch("wonderbot.celery.environment_claim.delay") as claim, \
+                mock.patch("wonderbot.celery.pool_refill.delay"):
+            environment = Environment.pool_claim("pr-1", DEFAULT_REPOSITORY_URL, "feature", "a" * 40)
+        claim.assert_called_once_with(environment.pk)
+        return environment
+
+    def test_claim_records_previous_name(self, notify):
+        environment = self._claim()
+        self.assertEqual((environment.name, environment.previous_name), ("pr-1", "pool-abc"))
+        self.assertFalse(environment.pooled)
+        self.assertIsNone(Environment.pool_claim("pr-2", DEFAULT_REPOSITORY_URL, "feature", "b" * 40))
+
+    def test_deleted_before_claim_task(self, notify):
+        environment = self._claim()
+        # Deleted before the claim task moved the files to the new name
+        with mock.patch.object(cmd, "dir_delete") as delete, mock.patch("staging.models.worktree_prune") as prune:
+            environment._nginx_delete()
+        self.assertEqual([c[0][0] for c in delete.call_args_list],
+                         ["%s/pr-1" % (NGINX_ROOTS,), "%s/pool-abc" % (NGINX_ROOTS,)])
+        prune.assert_called_once_with(environment.repository)
+        environment.refresh_from_db()
+        self.assertEqual(environment.previous_name, "")
+
+    def test_rebind_once(self, notify):
+        environment = self._claim()
+        with mock.patch("os.path.isdir", return_value=True), mock.patch.object(cmd, "dir_delete"), \
+                mock.patch("staging.models.worktree_move") as move, \
+                mock.patch.object(Environment, "_jorvik_configure") as configure:
+            environment._pool_rebind()
+            environment._pool_rebind()
+        move.assert_called_once_with(environment.repository, "%s/pool-abc" % (NGINX_ROOTS,),
+                                     "%s/pr-1" % (NGINX_ROOTS,))
+        configure.assert_called_once_with()
+        environment.refresh_from_db()
+        self.assertEqual(environment.previous_name, "")
+
+
+class StaticCollectTest(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        patcher = mock.patch.object(statics, "STATIC_STORE_PATH", "%s/store" % (self.root,))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _source(self, name, contents):
+        path = "%s/src/%s" % (self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wt") as f:
+            f.write(contents)
+        return path
+
+    def _collect(self, environment, sources):
+        return statics.static_collect("%s/%s/static" % (self.root, environment), sources,
+                                      "%s/%s/manifest.json" % (self.root, environment))
+
+    def test_content_based(self):
+        sources = {"css/a.css": self._source("a.css", "a"), "js/b.js": self._source("b.js", "b")}
+        self.assertEqual(self._collect("one", sources), (0, 0, 2, 0))
+        self.assertEqual(self._collect("two", sources), (0, 2, 0, 0))
+        target = "%s/one/static/css/a.css" % (self.root,)
+        inode = os.stat(target).st_ino
+        self.assertEqual(os.stat("%s/two/static/css/a.css" % (self.root,)).st_ino, inode)
+
+        # Unchanged files are left alone, even if their source was touched
+        os.utime(sources["css/a.css"], (0, 0))
+        self.assertEqual(self._collect("one", sources), (2, 0, 0, 0))
+        self.assertEqual(os.stat(target).st_ino, inode)
+
+        # A changed source older than the shared blob is still collected
+        self._source("a.css", "A")
+        os.utime(sources["css/a.css"], (1, 1))
+        self.assertEqual(self._collect("one", sources), (1, 0, 1, 0))
+        with open(target) as f:
+            self.assertEqual(f.read(), "A")
+        with open("%s/two/static/css/a.css" % (self.root,)) as f:
+            self.assertEqual(f.read(), "a")
+
+    def test_removed(self):
+        sources = {"a.css": self._source("a.css", "a"), "b.css": self._source("b.css", "b")}
+        self._collect("one", sources)
+        del sources["b.css"]
+        self.assertEqual(self._collect("one", sources), (1, 0, 0, 1))
+        self.assertFalse(os.path.exists("%s/one/static/b.css" % (self.root,)))
+
+
+@mock.patch("staging.models.notify_environment_changed")
+class AutomaticSnapshotTest(TestCase):
+
+    def _run(self, pipeline, pooled=False):
+        environment, _ = Environment.objects.get_or_create(name="pr-1", pooled=pooled)
+        with mock.patch("staging.models.DB_SNAPSHOT_AUTOMATIC", True), \
+                mock.patch.object(Pipeline, "run"), \
+                mock.patch.object(Environment, "queue_for_snapshot") as queue:
+            environment._run_pipeline(pipeline, "test")
+        return queue
+
+    def test_after_migrations(self, notify):
+        self._run(CREATION).assert_called_once_with("migrated", automatic=True)
+        self._run(incremental_update(Changes("M\tanagrafica/views.py"))).assert_not_called()
+        self._run(DELETION).assert_not_called()
+
+    def test_not_pooled(self, notify):
+        self._run(CREATION, pooled=True).assert_not_called()
+
+
+class LockKeptTest(SimpleTestCase):
+
+    def test_extended_until_done(self):
+        lock = mock.Mock()
+        with lock_kept(lock, interval=0.01):
+            time.sleep(0.1)
+        extended = lock.extend.call_count
+        self.assertGreater(extended, 2)
+        lock.extend.assert_called_with(0.01)
+        time.sleep(0.05)
+        self.assertEqual(lock.extend.call_count, extended)
+
+
+@mock.patch("staging.models.notify_environment_changed")
+@mock.patch("wonderbot.celery.environment_update.apply_async")
+class UpdatePendingTest(TestCase):
+
+    def setUp(self):
+        self.environment = Environment.objects.create(name="pr-1", status=Environment.ACTIVE,
+                                                      sha="a" * 40, deployed_sha="a" * 40)
+
+    def test_debounced(self, update, notify):
+        with mock.patch("staging.models.github_superseded"):
+            self.environment.queue_for_update("b" * 40)
+            self.environment.queue_for_update("c" * 40)
+        self.assertEqual(update.call_count, 1)
+        Environment.updates_recover()
+        self.assertEqual(update.call_count, 1)
+
+    def test_lost_update_recovered(self, update, notify):
+        self.environment.queue_for_update("b" * 40)
+        Environment.objects.update(update_queued=timezone.now() - datetime.timedelta(days=1))
+        Environment.updates_recover()
+        self.assertEqual(update.call_count, 2)
+        # Claimed again, a push is absorbed by the new update
+        with mock.patch("staging.models.github_superseded"):
+            Environment.objects.get().queue_for_update("c" * 40)
+        self.assertEqual(update.call_count, 2)
+        self.assertEqual(Environment.objects.get().sha, "c" * 40)
+
+
+@mock.patch("staging.models.postgres_dump_signature", return_value="1496900000-1024")
+class DatabaseTemplateTest(TestCase):
+
+    def test_created_once(self, signature):
+        template = DatabaseTemplate._create_if_outdated()
+        self.assertEqual(template.status, DatabaseTemplate.BUILDING)
+        self.assertTrue(template.name.endswith("_%d" % (template.pk,)))
+        self.assertIsNone(DatabaseTemplate._create_if_outdated())
+        self.assertEqual(DatabaseTemplate.objects.count(), 1)
+
+    def test_failed_retried_once(self, signature):
+        DatabaseTemplate.objects.create(dump_signature="1496900000-1024", status=DatabaseTemplate.FAILED)
+        template = DatabaseTemplate._create_if_outdated()
+        self.assertEqual(template.status, DatabaseTemplate.BUILDING)
+        self.assertIsNone(DatabaseTemplate._create_if_outdated())
+
+
+class HousekeepingTest(TestCase):
+
+    def test_step_failure_contained(self):
+        with mock.patch("staging.models.venv_evict", side_effect=OSError("busy")), \
+                mock.patch("staging.models.vassals_rebalance"), \
+                mock.patch("staging.models.static_store_gc") as gc, \
+                mock.patch("staging.models.log_prune_deleted") as prune:
+            housekeeping()
+        gc.assert_called_once_with()
+        prune.assert_called_once_with(mock.ANY)
+
+
+class MaintenanceWindowTest(SimpleTestCase):
+
+    @mock.patch("staging.maintenance.DB_MAINTENANCE_WINDOW", (2, 6))
+    def test_in_time_zone(self):
+        at = datetime.datetime(2017, 6, 8, 3, 0, tzinfo=timezone.utc)
+        with self.settings(TIME_ZONE="UTC"):
+            self.assertTrue(in_maintenance_window(at))
+        # Same instant, 05:00 in Rome
+        with self.settings(TIME_ZONE="Europe/Rome"):
+            self.assertTrue(in_maintenance_window(at))
+            self.assertFalse(in_maintenance_window(at + datetime.timedelta(hours=1)))
+
+
+class VenvEnsureTest(SimpleTestCase):
+
+    def test_pip_runs_in_environment_root(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        with open("%s/requirements.txt" % (root,), "wt") as f:
+            f.write("-e .\n")
+        with mock.patch("staging.venvs.VENV_CACHE_PATH", "%s/venvs" % (root,)), \
+                mock.patch("staging.venvs.venv_key", return_value="key"), \
+                mock.patch.object(cmd, "execute") as execute, mock.patch.object(cmd, "file_write"):
+            venv_ensure("%s/requirements.txt" % (root,))
+        pip = [c for c in execute.call_args_list if c[0][0][0] == "pip"]
+        self.assertEqual(len(pip), 1)
+        self.assertEqual(pip[0][1]["cwd"], root)
+
+
+@mock.patch("staging.github.github_token", return_value="token")
+class StatusReporterTest(SimpleTestCase):
+
+    def _reporter(self, statuses):
+        reporter = StatusReporter(api_url="http://github.invalid", backoff=0.2, retries=2)
+        sent = []
+
+        def post(url, **kwargs):
+            sha = url.rsplit("/", 1)[1]
+            sent.append((sha, time.time(), json.loads(kwargs["data"])["state"]))
+            return mock.Mock(status_code=statuses[sha])
+
+        reporter._start()
+        reporter.session = mock.Mock(post=post)
+        return reporter, sent
+
+    def test_retry_does_not_hold_up_others(self, token):
+        reporter, sent = self._reporter({"failing": 502, "fine": 201})
+        reporter.send("failing", "pending", "", "")
+        time.sleep(0.05)
+        reporter.send("fine", "pending", "", "")
+        self.assertTrue(reporter.flush(5))
+        self.assertEqual([status[0] for status in sent], ["failing", "fine", "failing", "failing"])
+        # Sent right away, while the failing one waits for its retry
+        self.assertLess(sent[1][1] - sent[0][1], 0.15)
+
+    def test_superseded_not_retried(self, token):
+        reporter, sent = self._reporter({"sha": 502})
+        reporter.send("sha", "pending", "", "")
+        time.sleep(0.05)
+        reporter.send("sha", "success", "", "")
+        self.assertTrue(reporter.flush(5))
+        # The pending status is not retried, the success is, as many times as allowed
+        self.assertEqual([status[2] for status in sent], ["pending", "success", "success", "success"])
+
+
+@mock.patch("staging.models.notify_environment_changed")
+class VassalStateTest(TestCase):
+
+    def setUp(self):
+        self.hot = Environment.objects.create(name="pr-1", status=Environment.ACTIVE)
+        Environment.objects.create(name="pr-2", status=Environment.ACTIVE)
+
+    def test_probe_notifies_changes(self, notify):
+        client = mock.Mock()
+        client.hgetall.return_value = {b"pr-1": b"cold", b"pr-2": b"cold"}
+        with mock.patch.object(vassals, "redis_client", return_value=client), \
+                mock.patch.object(vassals, "vassal_state", side_effect=lambda n: "hot" if n == "pr-1" else "cold"):
+            Environment.vassals_probe()
+        notify.assert_called_once_with(self.hot.pk)
+        client.pipeline.return_value.hset.assert_any_call(vassals.VASSAL_STATES_KEY, "pr-1", "hot")
+
+    def test_etag_follows_state(self, notify):
+        with mock.patch("staging.views.vassal_states", return_value=["cold", "cold"]):
+            etag = self.client.get("/api/environments/")["ETag"]
+            self.assertEqual(self.client.get("/api/environments/", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        with mock.patch("staging.views.vassal_states", return_value=["hot", "cold"]):
+            self.assertEqual(self.client.get("/api/environments/", HTTP_IF_NONE_MATCH=etag).status_code, 200)
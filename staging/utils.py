@@ -1,5 +1,10 @@
+import contextlib
+import fcntl
+import math
 import random
+import re
 import string
+import time
 
 
 def random_alphanumerical_string(alphabet, l):
@@ -18,3 +23,56 @@ def get_branch_name_from_ref(ref):
     if ref.count('/') < 2:
         return ref
     return ref.split('/')[2]
+
+
+def is_sha(value):
+    return bool(value and re.match(r"^[0-9a-f]{40}$", value))
+
+
+@contextlib.contextmanager
+def file_lock(filename):
+    """
+    Exclusive lock on a file, shared across worker processes.
+    """
+    with open(filename, "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def file_semaphore(filename, slots, interval=0.5, waiting=None):
+    """
+    Like file_lock, but up to `slots` holders at the same time, each locking one of
+    the files `filename`.0, `filename`.1, ... Polls every `interval` seconds until a slot
+    is free, calling `waiting()` each time (which may raise to give up).
+    """
+    while True:
+        for slot in range(slots):
+            f = open("%s.%d" % (filename, slot), "w")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                continue
+            try:
+                yield slot
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+                f.close()
+            return
+        if waiting:
+            waiting()
+        time.sleep(interval)
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of a list of numbers, or None if the list is empty.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
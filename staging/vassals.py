@@ -0,0 +1,198 @@
+import glob
+import json
+import os
+import socket
+
+from redis.exceptions import RedisError
+
+import staging.cmd as cmd
+from staging.locks import redis_client
+from staging.scheduler import cpu_count, memory_total
+from staging.utils import percentile
+from wonderbot.settings import UWSGI_SOCKETS_PATH, UWSGI_PROCESSES, UWSGI_THREADS, UWSGI_ON_DEMAND, \
+    UWSGI_IDLE_TIMEOUT, UWSGI_STATS_TIMEOUT, UWSGI_MEMORY_FRACTION, UWSGI_PROCESSES_PER_CORE, \
+    UWSGI_WORKER_RSS, NGINX_ROOTS
+
+
+def vassal_socket(name):
+    """
+    Socket the environment is served on, as set for all vassals and expected by nginx
+    (see cfg/uwsgi.txt and cfg/nginx.txt).
+    """
+    return "%s/%s.sock" % (UWSGI_SOCKETS_PATH, name)
+
+
+def vassal_stats_socket(name):
+    return "%s/%s.stats.sock" % (UWSGI_SOCKETS_PATH, name)
+
+
+def vassal_sizing(environments):
+    """
+    Returns the (processes, threads) of each of `environments` vassals, so that all of them
+    at full load fit in UWSGI_MEMORY_FRACTION of the memory, given the measured size of a
+    worker, and in UWSGI_PROCESSES_PER_CORE processes per core.
+    """
+    environments = max(1, environments)
+    rss = vassal_worker_rss() or UWSGI_WORKER_RSS
+    processes = UWSGI_PROCESSES
+    memory = memory_total()
+    if memory:
+        processes = min(processes, int(memory * UWSGI_MEMORY_FRACTION / (environments * rss)))
+    processes = min(processes, cpu_count() * UWSGI_PROCESSES_PER_CORE // environments)
+    processes = max(1, processes)
+    # Fewer processes serve concurrent requests with more threads
+    threads = UWSGI_THREADS * max(1, UWSGI_PROCESSES // (2 * processes))
+    return processes, threads
+
+
+def vassal_worker_rss():
+    """
+    Median resident memory of the workers running right now, or None if there are none.
+    """
+    sizes = []
+    for config in glob.glob("%s/*/uwsgi.ini" % (NGINX_ROOTS,)):
+        stats = vassal_stats(os.path.basename(os.path.dirname(config)))
+        sizes += [w["rss"] for w in (stats or {}).get("workers", []) if w.get("pid") and w.get("rss")]
+    return percentile(sizes, 50)
+
+
+def vassal_config(name, processes=UWSGI_PROCESSES, threads=UWSGI_THREADS):
+    """
+    Returns the uwsgi.ini of an environment. Its workers are scaled between one and `processes`
+    by the cheaper subsystem, depending on the load. After UWSGI_IDLE_TIMEOUT seconds without
+    requests, the vassal exits if the emperor can start it on demand, otherwise its workers do.
+    """
+    config = "[uwsgi]\n" \
+             "plugins = python3\n" \
+             "module = jorvik.wsgi:application\n" \
+             "virtualenv = %%d/.venv\n" \
+             "chdir = %%d\n" \
+             "stats = %(stats)s\n" \
+             "master = true\n" \
+             "processes = %(processes)d\n" \
+             "threads = %(threads)d\n" \
+             "idle = %(idle)d\n" \
+             "memory-report = true\n" \
+             "vacuum = True\n" % {
+                 "stats": vassal_stats_socket(name),
+                 "processes": processes, "threads": threads, "idle": UWSGI_IDLE_TIMEOUT,
+             }
+    if processes > 1:
+        # uWSGI refuses a cheaper value not lower than processes
+        config += "cheaper-algo = spare\n" \
+                  "cheaper = 1\n" \
+                  "cheaper-initial = 1\n" \
+                  "cheaper-step = 1\n"
+    if UWSGI_ON_DEMAND:
+        config += "die-on-idle = true\n"
+    else:
+        config += "cheap = true\n"
+    return config
+
+
+def vassal_write(name, root, **kwargs):
+    """
+    Writes the uwsgi.ini of the environment in `root`, and its uwsgi.ini.socket, which makes
+    the emperor bind the socket itself and only start the vassal on the first connection.
+    Files are only written if their contents change, since the emperor reloads a vassal
+    whenever its files are touched. Returns whether anything was written.
+    """
+    changed = _write_if_changed("%s/uwsgi.ini" % (root,), vassal_config(name, **kwargs))
+    if UWSGI_ON_DEMAND:
+        changed = _write_if_changed("%s/uwsgi.ini.socket" % (root,), vassal_socket(name)) or changed
+    elif os.path.exists("%s/uwsgi.ini.socket" % (root,)):
+        cmd.file_delete("%s/uwsgi.ini.socket" % (root,))
+        changed = True
+    return changed
+
+
+def _write_if_changed(filename, contents):
+    try:
+        with open(filename) as f:
+            if f.read() == contents:
+                return False
+    except OSError:
+        pass
+    # Replaced atomically, the emperor never reads a half-written file
+    cmd.file_write("%s.new" % (filename,), contents)
+    os.replace("%s.new" % (filename,), filename)
+    return True
+
+
+def vassal_stats(name, timeout=UWSGI_STATS_TIMEOUT):
+    """
+    Statistics of a running vassal, as reported by its stats server, or None if it is not running.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(vassal_stats_socket(name))
+        data = b""
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        return json.loads(data.decode("utf-8"))
+    except (OSError, ValueError):
+        return None
+    finally:
+        client.close()
+
+
+VASSAL_STATES_KEY = "wonderbot:vassals"
+
+
+def vassal_state_cached(name):
+    """
+    The state of a vassal as last probed (see vassal_states_refresh), probing it if it never was.
+    """
+    try:
+        state = redis_client().hget(VASSAL_STATES_KEY, name)
+        if state is not None:
+            return state.decode("utf-8")
+        state = vassal_state(name)
+        redis_client().hset(VASSAL_STATES_KEY, name, state)
+        return state
+    except RedisError:
+        return vassal_state(name)
+
+
+def vassal_states(names):
+    """
+    The cached states of several vassals, "" for those never probed, in a single round-trip.
+    """
+    if not names:
+        return []
+    try:
+        return [(state or b"").decode("utf-8") for state in redis_client().hmget(VASSAL_STATES_KEY, names)]
+    except RedisError:
+        return [""] * len(names)
+
+
+def vassal_states_refresh(names):
+    """
+    Probes the vassals `names` and caches their states, forgetting any other.
+    Returns the names whose state has changed.
+    """
+    states = dict((name, vassal_state(name)) for name in names)
+    client = redis_client()
+    previous = dict((name.decode("utf-8"), state.decode("utf-8"))
+                    for name, state in client.hgetall(VASSAL_STATES_KEY).items())
+    pipeline = client.pipeline()
+    pipeline.delete(VASSAL_STATES_KEY)
+    for name, state in states.items():
+        pipeline.hset(VASSAL_STATES_KEY, name, state)
+    pipeline.execute()
+    return [name for name, state in states.items() if previous.get(name) != state]
+
+
+def vassal_state(name):
+    """
+    Returns "hot" if the environment has worker processes running, "cold" otherwise.
+    """
+    stats = vassal_stats(name)
+    if not stats:
+        return "cold"
+    workers = [w for w in stats.get("workers", []) if w.get("pid") and w.get("status") != "cheap"]
+    return "hot" if workers else "cold"
@@ -0,0 +1,95 @@
+import hashlib
+import os
+
+import staging.cmd as cmd
+from staging.utils import file_lock
+from wonderbot.settings import VENV_CACHE_PATH, VENV_PYTHON, VENV_CACHE_MAX_ENTRIES, VENV_CACHE_MAX_BYTES
+
+READY_MARKER = ".wonderbot-ready"
+
+
+def venv_key(requirements):
+    """
+    Returns the cache key of a requirements file, i.e. a hash of its contents
+    and of the Python version the virtualenv would be built with.
+    """
+    version = cmd.execute([VENV_PYTHON, "-c", "import sys; print(sys.version)"], capture=True).out
+    h = hashlib.sha256(version.encode("utf-8"))
+    with open(requirements, "rb") as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+
+def venv_path(key):
+    return "%s/%s" % (VENV_CACHE_PATH, key)
+
+
+def venv_ensure(requirements):
+    """
+    Makes sure a virtualenv for the given requirements file is in the cache,
+    building it if needed. Returns its cache key.
+    """
+    key = venv_key(requirements)
+    path = venv_path(key)
+    os.makedirs(VENV_CACHE_PATH, exist_ok=True)
+    with file_lock("%s.lock" % path):
+        if not os.path.exists("%s/%s" % (path, READY_MARKER)):
+            cmd.dir_delete(path)
+            try:
+                cmd.execute(["python3", "-m", "virtualenv", "-p%s" % (VENV_PYTHON,), path])
+                # From the environment root, which relative lines (e.g. "-e ." or "./vendor/...") refer to
+                cmd.execute(["pip", "install", "-r", requirements], cwd=os.path.dirname(requirements),
+                            venv=path, kind="pip")
+            except cmd.CommandError:
+                cmd.dir_delete(path)
+                raise
+        cmd.file_write("%s/%s" % (path, READY_MARKER), requirements)
+    return key
+
+
+def venv_link(key, root):
+    """
+    Points `root`/.venv to a cached virtualenv, atomically.
+    """
+    link = "%s/.venv" % (root,)
+    if os.path.isdir(link) and not os.path.islink(link):
+        # Virtualenv built in place, before the cache was introduced
+        cmd.dir_delete(link)
+    os.symlink(venv_path(key), "%s.new" % (link,))
+    os.replace("%s.new" % (link,), link)
+
+
+def _venv_size(path):
+    size = 0
+    for directory, _, files in os.walk(path):
+        for filename in files:
+            filename = os.path.join(directory, filename)
+            if not os.path.islink(filename):
+                size += os.path.getsize(filename)
+    return size
+
+
+def venv_evict(keep):
+    """
+    Deletes the least recently used virtualenvs not in `keep`, until the cache
+    fits in VENV_CACHE_MAX_ENTRIES and VENV_CACHE_MAX_BYTES.
+    """
+    if not os.path.isdir(VENV_CACHE_PATH):
+        return
+    entries = []
+    for key in os.listdir(VENV_CACHE_PATH):
+        marker = "%s/%s" % (venv_path(key), READY_MARKER)
+        if os.path.exists(marker):
+            entries.append((os.path.getmtime(marker), key, _venv_size(venv_path(key))))
+    entries.sort()
+
+    total = sum(size for _, _, size in entries)
+    for _, key, size in entries:
+        if len(entries) <= VENV_CACHE_MAX_ENTRIES and total <= VENV_CACHE_MAX_BYTES:
+            break
+        if key in keep:
+            continue
+        with file_lock("%s.lock" % venv_path(key)):
+            cmd.dir_delete(venv_path(key))
+        entries = [e for e in entries if e[1] != key]
+        total -= size
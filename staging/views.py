@@ -1,13 +1,28 @@
-import json
-
-from django.http import HttpResponse
-from django.shortcuts import render
+import hashlib
+import re
+
+from django.core.paginator import Paginator, InvalidPage
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Max
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse
+from django.shortcuts import render, get_object_or_404, redirect
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.text import slugify
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
+from kombu.exceptions import OperationalError
+from redis.exceptions import RedisError
 
 from staging.github import github_commit_status, github_pending
-from staging.models import Environment, AllowedRepository
-from staging.utils import get_branch_name_from_ref
-from wonderbot.settings import HOME_URL
+from staging.logs import log_latest_run, log_tail
+from staging.models import Environment, AllowedRepository, StageRun, Snapshot, WebhookDelivery
+from staging.notifications import environment_changes
+from staging.vassals import vassal_states
+from staging.webhooks import webhook_signature_valid
+from wonderbot.settings import HOME_URL, ENVIRONMENTS_PER_PAGE, LONG_POLL_TIMEOUT
+
+FILTERS = ("repository", "branch", "status")
 
 
 def index(request):
@@ -16,19 +31,13 @@ def index(request):
 
         ids = request.POST.getlist('environment_ids', default=[])
         ids = [int(x) for x in ids]
-        selection = Environment.objects.filter(pk__in=ids)
-
-        if request.POST["action"] == "refresh":
-            [e.queue_for_refresh() for e in selection]
 
-        elif request.POST["action"] == "update":
-            [e.queue_for_update() for e in selection]
+        if request.POST["action"] in ("refresh", "update", "recreate", "delete"):
+            Environment.queue_batch(request.POST["action"], ids)
 
-        elif request.POST["action"] == "recreate":
-            [e.queue_for_recreation() for e in selection]
-
-        elif request.POST["action"] == "delete":
-            [e.queue_for_deletion() for e in selection]
+        if request.POST["action"] == "snapshot":
+            name = _snapshot_name(request.POST.get("snapshot_name"))
+            [e.queue_for_snapshot(name) for e in Environment.objects.filter(pk__in=ids)]
 
         if request.POST["action"] == "create":
             name = request.POST["name"].lower().strip()
@@ -40,112 +49,195 @@ def index(request):
             e.save()
             e.queue_for_creation()
 
-    context = {"environments": Environment.objects.all(),
+    page = _environments_page(request)
+    filters = {name: request.GET.get(name, "") for name in FILTERS}
+    context = {"environments": page,
+               "filters": filters,
+               "query": _environments_query(request),
+               "etag": _environments_etag(request),
+               "statuses": Environment.STATUS,
                "repositories": AllowedRepository.objects.all(),
+               "statistics": StageRun.statistics(),
                "hook_url": "%s/hook/" % HOME_URL}
     return render(request, "index.html", context)
 
 
-@csrf_exempt
-def github_hook(request):
+def _environments(request):
     """
-    Handles all GitHub requests.
+    The environments matching the filters in the query string.
     """
+    environments = Environment.objects.order_by('pk')
+    for name in FILTERS:
+        if request.GET.get(name):
+            environments = environments.filter(**{name: request.GET[name]})
+    return environments
 
-    if request.method != "POST":
-        return HttpResponse("Ignoring non-POST requests.")
-
-    # Security signature
-    # hub_signature = request.META["HTTP_X_HUB_SIGNATURE"]
-    delivery = request.META["HTTP_X_GITHUB_DELIVERY"]
-
-    # TODO check security!
-    # See https://developer.github.com/webhooks/securing/
 
-    event = request.META["HTTP_X_GITHUB_EVENT"]
-    data = json.loads(request.body.decode('utf-8'))
+def _environments_page(request):
+    paginator = Paginator(_environments(request), ENVIRONMENTS_PER_PAGE)
+    try:
+        return paginator.page(request.GET.get("page", 1))
+    except InvalidPage:
+        return paginator.page(paginator.num_pages)
 
-    if event == "pull_request":
 
-        action = data["action"]
-        number = data["number"]
-        repo = data["pull_request"]["head"]["repo"]["ssh_url"]
-        branch = get_branch_name_from_ref(data["pull_request"]["head"]["ref"])
-        sha = data["pull_request"]["head"]["sha"]
-
-        if not AllowedRepository.objects.filter(url=repo).exists():
-            return HttpResponse("Repository %s is not allowed. Ignored." % (repo,))
-
-        if action in ["opened", "reopened"]:
-            return _do_opened_pull_request(number, repo, branch, sha)
-
-        elif action == "closed":
-            return _do_closed_pull_request(number)
-
-        elif action == "synchronize":
-            return _do_push(repo, branch, sha)
-        
-        else:
-            return HttpResponse("%s action on PR %d ignored." % (action, number),
-                                content_type="text/plain")
-
-    elif event == "push":
-
-        repo = data["repository"]["ssh_url"]
-        branch = get_branch_name_from_ref(data["ref"])
-        sha = data["after"]
+def _environments_query(request):
+    """
+    The part of the query string selecting environments, i.e. filters and page.
+    """
+    query = request.GET.copy()
+    for name in list(query.keys()):
+        if name not in FILTERS + ("page",):
+            del query[name]
+    return query.urlencode()
 
-        return _do_push(repo, branch, sha)
 
-    else:
-        return HttpResponse("%s event ignored." % event,
-                            content_type="text/plain")
+def _environments_etag(request):
+    """
+    Changes whenever any of the environments selected by the request is created, saved or deleted,
+    or its vassal starts or stops (as last probed, see Environment.vassals_probe).
+    """
+    environments = _environments(request)
+    latest = environments.aggregate(updated=Max('updated'), count=Count('pk'))
+    states = vassal_states(list(environments.values_list('name', flat=True)))
+    key = "%s|%s|%s|%s" % (latest["updated"], latest["count"], _environments_query(request), ",".join(states))
+    return hashlib.md5(key.encode("utf-8")).hexdigest()
 
 
-def _do_opened_pull_request(number, repo, branch, sha):
+@condition(etag_func=_environments_etag)
+def environments_api(request):
     """
-    React to a new pull request being opened.
+    State of the environments, as JSON. Supports conditional GET with If-None-Match.
     """
-
-    name = _environment_name_for_pr(number)
-    environment = Environment(name=name, status=Environment.CREATING,
-                              repository=repo, branch=branch, sha=sha)
-    environment.save()
-    environment.queue_for_creation()
-    return HttpResponse("OK", content_type="text/plain")
+    page = _environments_page(request)
+    environments = []
+    for environment in page:
+        data = environment.as_dict()
+        data["row"] = render_to_string("environment_row.html", {"environment": environment})
+        environments.append(data)
+    return JsonResponse({"environments": environments,
+                         "page": page.number,
+                         "pages": page.paginator.num_pages,
+                         "count": page.paginator.count})
+
+
+def environments_wait(request):
+    """
+    Long-poll: returns as soon as any environment changes, or immediately if the `etag` in
+    the query string is outdated, or after LONG_POLL_TIMEOUT seconds otherwise.
+    """
+    try:
+        with environment_changes() as wait:
+            changed = request.GET.get("etag") != _environments_etag(request) or wait(LONG_POLL_TIMEOUT)
+    except RedisError:
+        # No push channel, the page will fall back to polling
+        return JsonResponse({"changed": False, "available": False})
+    return JsonResponse({"changed": changed, "available": True})
 
 
-def _do_closed_pull_request(number):
+def environment_runs(request, pk):
+    """
+    Provisioning history of an environment, one entry per pipeline run.
     """
-    React to a pull request being closed.
+    environment = get_object_or_404(Environment, pk=pk)
+    runs = []
+    for stage_run in environment.stage_runs.order_by('-started'):
+        if not runs or runs[-1]["run"] != stage_run.run:
+            runs.append({"run": stage_run.run, "operation": stage_run.operation,
+                         "started": stage_run.started, "stages": []})
+        runs[-1]["stages"].insert(0, stage_run)
+    for run in runs:
+        run["started"] = min(s.started for s in run["stages"])
+        run["duration"] = max((s.started - run["started"]).total_seconds() + (s.duration or 0)
+                              for s in run["stages"])
+        run["failed"] = any(s.exit_code for s in run["stages"])
+    context = {"environment": environment, "runs": runs}
+    return render(request, "runs.html", context)
+
+
+def environment_log(request, pk):
     """
-    name = _environment_name_for_pr(number)
-    environment = Environment.objects.get(name=name)
-    environment.queue_for_deletion()
-    return HttpResponse("OK", content_type="text/plain")
+    Output of a run (by default, the latest) of an environment, following it while it is written.
+    """
+    environment = get_object_or_404(Environment, pk=pk)
+    run = request.GET.get("run") or log_latest_run(environment.pk)
+    context = {"environment": environment, "run": run}
+    return render(request, "log.html", context)
 
 
-def _do_push(repo, branch, sha):
+def environment_log_api(request, pk):
+    """
+    Tail of the log of a run, as JSON. Pass back the returned `offset` to get the output written since.
+    """
+    environment = get_object_or_404(Environment, pk=pk)
+    run = request.GET.get("run") or log_latest_run(environment.pk)
+    if not run or not re.match(r"^[0-9a-f]{32}$", run):
+        raise Http404("No log found.")
+    try:
+        offset = int(request.GET["offset"]) if request.GET.get("offset") else None
+    except ValueError:
+        return HttpResponseBadRequest("Invalid offset.")
+    text, offset, missed, more = log_tail(environment.pk, run, offset)
+    return JsonResponse({"run": run, "text": text, "offset": offset, "missed": missed, "more": more,
+                         "running": environment.status not in (Environment.ACTIVE, Environment.FAILED)})
+
+
+def environment_snapshots(request, pk):
     """
-    React to commits being pushed to a branch.
+    Snapshots of the database of an environment, which can be taken, restored and deleted.
     """
-    environments = Environment.objects.filter(repository=repo, branch=branch)
-    if not environments.exists():
-        return HttpResponse("Ignoring, no environment found for repo %s and branch %s." % (repo, branch),
-                            content_type="text/plain")
+    environment = get_object_or_404(Environment, pk=pk)
+
+    if request.POST:
+        if request.POST["action"] == "take":
+            environment.queue_for_snapshot(_snapshot_name(request.POST.get("name")))
 
-    for environment in environments:
-        environment.sha = sha
-        environment.save()
-        environment.queue_for_update()
+        elif request.POST["action"] in ("restore", "delete"):
+            snapshot = get_object_or_404(environment.snapshots, pk=int(request.POST["snapshot_id"]),
+                                         status=Snapshot.READY)
+            if request.POST["action"] == "delete":
+                environment.queue_for_snapshot_deletion(snapshot)
+            elif environment.status in (Environment.ACTIVE, Environment.FAILED):
+                environment.queue_for_snapshot_restore(snapshot)
 
-    return HttpResponse("OK", content_type="text/plain")
+        return redirect(request.path)
 
+    context = {"environment": environment, "snapshots": environment.snapshots.all()}
+    return render(request, "snapshots.html", context)
 
-def _environment_name_for_pr(number):
+
+def _snapshot_name(name):
+    name = slugify(name or "")[:64]
+    return name or timezone.now().strftime("snapshot-%Y%m%d-%H%M")
+
+
+@csrf_exempt
+def github_hook(request):
     """
-    Get an environment name for a pull request given its number.
-    :param number: The PR number.
-    :return: The name string.
+    Handles all GitHub requests. Deliveries are only checked and recorded here, GitHub gets
+    an answer right away and the events are processed in the background (see staging.webhooks).
+    Deliveries already received, e.g. redelivered, are ignored.
     """
-    return "pr-%d" % number
+
+    if request.method != "POST":
+        return HttpResponse("Ignoring non-POST requests.")
+
+    signature = request.META.get("HTTP_X_HUB_SIGNATURE_256") or request.META.get("HTTP_X_HUB_SIGNATURE")
+    if not webhook_signature_valid(request.body, signature):
+        return HttpResponseForbidden("Invalid signature.", content_type="text/plain")
+
+    delivery = WebhookDelivery(delivery=request.META["HTTP_X_GITHUB_DELIVERY"],
+                               event=request.META["HTTP_X_GITHUB_EVENT"],
+                               payload=request.body.decode('utf-8'))
+    try:
+        with transaction.atomic():
+            delivery.save()
+    except IntegrityError:
+        return HttpResponse("Delivery %s already received." % (delivery.delivery,), content_type="text/plain")
+
+    try:
+        delivery.queue_for_processing()
+    except OperationalError:
+        # Recorded, it is queued again once the broker is back (see WebhookDelivery.requeue_stale)
+        pass
+    return HttpResponse("Accepted.", status=202, content_type="text/plain")
@@ -0,0 +1,158 @@
+import hashlib
+import hmac
+import json
+import os
+
+from django.db.models import F
+from django.utils import timezone
+
+from staging.models import AllowedRepository, Environment, WebhookDelivery
+from staging.utils import get_branch_name_from_ref
+from wonderbot.settings import GITHUB_WEBHOOK_SECRET_FILE
+
+_secret = (None, None)
+
+
+def webhook_secret():
+    """
+    Reads the secret shared with GitHub to sign the deliveries, caching it until the file changes.
+    Returns None if no secret is found.
+    """
+    global _secret
+    try:
+        mtime = os.path.getmtime(GITHUB_WEBHOOK_SECRET_FILE)
+        if _secret[0] != mtime:
+            with open(GITHUB_WEBHOOK_SECRET_FILE, "rt") as f:
+                _secret = (mtime, f.readline().rstrip("\n"))
+        return _secret[1]
+    except OSError:
+        return None
+
+
+def webhook_signature_valid(body, signature):
+    """
+    Checks the signature of a delivery (X-Hub-Signature-256 or X-Hub-Signature), i.e. the HMAC
+    of its body with the shared secret. Nothing is valid if no secret is set.
+    See https://developer.github.com/webhooks/securing/
+    """
+    secret = webhook_secret()
+    if not secret or not signature or "=" not in signature:
+        return False
+    algorithm, digest = signature.split("=", 1)
+    if algorithm not in ("sha1", "sha256"):
+        return False
+    expected = hmac.new(secret.encode("utf-8"), body, getattr(hashlib, algorithm)).hexdigest()
+    return hmac.compare_digest(expected, digest)
+
+
+def webhook_deliver(delivery_id):
+    """
+    Processes a recorded delivery, unless it already has been or is being (e.g. it was queued
+    again). A failed delivery is released, to be retried by WebhookDelivery.requeue_stale.
+    """
+    now = timezone.now()
+    claimed = WebhookDelivery.objects.filter(WebhookDelivery.q_claimable(now), pk=delivery_id)\
+        .update(started=now, attempts=F("attempts") + 1)
+    if not claimed:
+        return
+    delivery = WebhookDelivery.objects.get(pk=delivery_id)
+    try:
+        delivery.result = webhook_route(delivery.event, json.loads(delivery.payload))
+        delivery.processed = timezone.now()
+    except Exception as e:
+        delivery.result = "Failed: %r" % (e,)
+        delivery.started = None
+        raise
+    finally:
+        delivery.save(update_fields=["result", "started", "processed"])
+        print("# Delivery %s (%s), attempt %d: %s" % (delivery.delivery, delivery.event, delivery.attempts,
+                                                       delivery.result))
+
+
+def webhook_route(event, data):
+    """
+    Handles a GitHub event. Returns what was done.
+    """
+
+    if event == "pull_request":
+
+        action = data["action"]
+        number = data["number"]
+        repo = data["pull_request"]["head"]["repo"]["ssh_url"]
+        branch = get_branch_name_from_ref(data["pull_request"]["head"]["ref"])
+        sha = data["pull_request"]["head"]["sha"]
+
+        if not AllowedRepository.objects.filter(url=repo).exists():
+            return "Repository %s is not allowed. Ignored." % (repo,)
+
+        if action in ["opened", "reopened"]:
+            return _do_opened_pull_request(number, repo, branch, sha)
+
+        elif action == "closed":
+            return _do_closed_pull_request(number)
+
+        elif action == "synchronize":
+            return _do_push(repo, branch, sha)
+
+        else:
+            return "%s action on PR %d ignored." % (action, number)
+
+    elif event == "push":
+
+        repo = data["repository"]["ssh_url"]
+        branch = get_branch_name_from_ref(data["ref"])
+        sha = data["after"]
+
+        return _do_push(repo, branch, sha)
+
+    else:
+        return "%s event ignored." % event
+
+
+def _do_opened_pull_request(number, repo, branch, sha):
+    """
+    React to a new pull request being opened.
+    """
+
+    name = _environment_name_for_pr(number)
+    if Environment.pool_claim(name, repo, branch, sha):
+        return "OK, environment %s taken from the pool." % (name,)
+
+    environment = Environment(name=name, status=Environment.CREATING,
+                              repository=repo, branch=branch, sha=sha)
+    environment.save()
+    environment.queue_for_creation()
+    return "OK"
+
+
+def _do_closed_pull_request(number):
+    """
+    React to a pull request being closed.
+    """
+    name = _environment_name_for_pr(number)
+    environment = Environment.objects.get(name=name)
+    environment.queue_for_deletion()
+    return "OK"
+
+
+def _do_push(repo, branch, sha):
+    """
+    React to commits being pushed to a branch.
+    """
+    environments = Environment.objects.filter(repository=repo, branch=branch)
+    if not environments.exists():
+        return "Ignoring, no environment found for repo %s and branch %s." % (repo, branch)
+
+    for environment in environments:
+        environment.queue_for_update(sha)
+
+    return "OK"
+
+
+def _environment_name_for_pr(number):
+    """
+    Get an environment name for a pull request given its number.
+    :param number: The PR number.
+    :return: The name string.
+    """
+    return "pr-%d" % number
@@ -1,6 +1,7 @@
 from __future__ import absolute_import, unicode_literals
+import functools
 import os
-from celery import Celery
+from celery import Celery, chord
 
 # set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'wonderbot.settings')
@@ -15,29 +16,203 @@ def debug_task(self):
     print('Request: {0!r}'.format(self.request))
 
 
-@app.task(bind=True)
+def environment_task(priority):
+    """
+    Decorates a task operating on an environment, given its primary key. The environment is
+    read from the database when the task starts, and no two such tasks run on the same
+    environment at the same time: the task is retried later if the environment is busy.
+    Likewise if the machine is too busy for an operation of this priority (see staging.scheduler).
+    """
+    return functools.partial(_environment_task, priority)
+
+
+def _environment_task(priority, function):
+
+    @app.task(bind=True, max_retries=None)
+    @functools.wraps(function)
+    def task(self, environment_id, *args, **kwargs):
+        from staging.locks import environment_lock, lock_kept, lock_release
+        from staging.models import Environment, queue_housekeeping
+        from staging.scheduler import admit
+        from wonderbot.settings import ENVIRONMENT_LOCK_RETRY_DELAY, SCHEDULER_RETRY_DELAY, \
+            SCHEDULER_MAX_DEFERRALS
+
+        # Counted apart from the retries, which also include waiting for the lock
+        deferrals = kwargs.pop("deferrals", 0)
+        busy = admit(priority)
+        if busy and deferrals < SCHEDULER_MAX_DEFERRALS:
+            print("# Deferring %s of environment %d: %s." % (self.name, environment_id, busy))
+            raise self.retry(kwargs=dict(kwargs, deferrals=deferrals + 1), countdown=SCHEDULER_RETRY_DELAY)
+
+        # Tasks part of a batch leave the housekeeping to the end of the batch
+        batch = kwargs.pop("batch", False)
+        lock = environment_lock(environment_id)
+        if not lock.acquire(blocking=False):
+            raise self.retry(countdown=ENVIRONMENT_LOCK_RETRY_DELAY)
+        try:
+            environment = Environment.objects.filter(pk=environment_id).first()
+            if environment is None:
+                print("# Environment %d no longer exists." % (environment_id,))
+                return
+            # The batch fetched the mirrors before dispatching its environments
+            environment.mirror_fetched = batch
+            with lock_kept(lock):
+                return function(self, environment, *args, **kwargs)
+        finally:
+            lock_release(lock)
+            if not batch:
+                queue_housekeeping()
+
+    return task
+
+
+@environment_task("create")
 def environment_create(self, environment):
     environment.do_creation()
 
 
+@environment_task("create")
+def environment_claim(self, environment):
+    environment.do_claim()
+
+
+@environment_task("background")
+def environment_pool_create(self, environment):
+    environment.do_pool_creation()
+
+
 @app.task(bind=True)
+def pool_refill(self):
+    from staging.models import Environment
+    Environment.pool_refill()
+
+
+@environment_task("background")
 def environment_recreate(self, environment):
-    environment.do_delete(delete_object=False)
-    environment.do_creation()
+    environment.do_recreation()
 
 
-@app.task(bind=True)
+@environment_task("background")
 def environment_refresh(self, environment):
     environment.do_refresh()
 
 
-@app.task(bind=True)
-def environment_update(self, environment):
-    environment.do_update()
+@environment_task("update")
+def environment_update(self, environment, full=True):
+    environment.do_update(full=full)
 
 
-@app.task(bind=True)
+@environment_task("delete")
 def environment_delete(self, environment):
     environment.do_delete()
 
 
+@environment_task("background")
+def environment_snapshot(self, environment, snapshot_id):
+    snapshot = environment.snapshots.get(pk=snapshot_id)
+    environment.do_snapshot(snapshot)
+
+
+@environment_task("background")
+def environment_snapshot_restore(self, environment, snapshot_id):
+    snapshot = environment.snapshots.get(pk=snapshot_id)
+    environment.do_snapshot_restore(snapshot)
+
+
+@environment_task("delete")
+def environment_snapshot_delete(self, environment, snapshot_id):
+    snapshot = environment.snapshots.get(pk=snapshot_id)
+    environment.do_snapshot_delete(snapshot)
+
+
+BATCH_TASKS = {
+    "refresh": environment_refresh,
+    "update": environment_update,
+    "recreate": environment_recreate,
+    "delete": environment_delete,
+}
+
+
+@app.task(bind=True)
+def environments_batch(self, action, environment_ids):
+    """
+    Runs the same action on several environments. The work they have in common (fetching
+    each repository, building the database template) is done once, before dispatching
+    the environments, and the cleanup once, after all of them are done.
+    """
+    from staging.models import DatabaseTemplate, Environment
+    from staging.repositories import mirror_fetch
+    environments = Environment.objects.filter(pk__in=environment_ids)
+    if not environments:
+        return
+    if action != "delete":
+        for repository in set(e.repository for e in environments):
+            mirror_fetch(repository)
+        DatabaseTemplate.build_if_outdated()
+    # Bulk actions are manual, so they run in the background queue, except deletions
+    queue = "delete" if action == "delete" else "background"
+    task = BATCH_TASKS[action]
+    finished = environments_batch_finished.si()
+    # A chord does not run its callback if any of its tasks fails, when cleaning up is needed the most
+    finished.link_error(environments_batch_finished.si())
+    chord(task.si(e.pk, batch=True).set(queue=queue) for e in environments)(finished)
+
+
+@app.task(bind=True)
+def environments_batch_finished(self):
+    from staging.models import housekeeping
+    housekeeping()
+
+
+@app.task(bind=True)
+def housekeeping_run(self):
+    from staging.models import housekeeping
+    housekeeping()
+
+
+@app.task(bind=True)
+def vassals_probe(self):
+    from staging.models import Environment
+    Environment.vassals_probe()
+
+
+@app.task(bind=True)
+def github_event(self, delivery_id):
+    from staging.webhooks import webhook_deliver
+    webhook_deliver(delivery_id)
+
+
+@app.task(bind=True)
+def github_events_requeue(self):
+    from staging.models import WebhookDelivery
+    WebhookDelivery.requeue_stale()
+    WebhookDelivery.prune()
+
+
+@app.task(bind=True)
+def database_template_build(self, template_id):
+    from staging.models import DatabaseTemplate
+    DatabaseTemplate.objects.get(pk=template_id).do_build()
+
+
+@app.task(bind=True)
+def database_template_check(self):
+    from staging.models import DatabaseTemplate
+    DatabaseTemplate.queue_for_build_if_outdated()
+
+
+@app.task(bind=True)
+def dump_ingest(self):
+    from staging.dumps import dump_ingest
+    from staging.models import DatabaseTemplate
+    if dump_ingest() is not None:
+        DatabaseTemplate.queue_for_build_if_outdated()
+
+
+@app.task(bind=True)
+def database_maintenance(self):
+    from staging.maintenance import maintenance_run
+    from staging.models import Environment
+    databases = Environment.objects.exclude(db_name__isnull=True).exclude(db_name="")\
+        .order_by('updated').values_list('db_name', flat=True)
+    maintenance_run(databases)
@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/1.10/ref/settings/
 
 import os
 
+from celery.schedules import crontab
+
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -129,26 +131,251 @@ DEFAULT_BRANCH = "master"
 
 HOME_URL = "http://wonderbot.gaia.cri.it"
 
+# Everything wonderbot manages lives under STAGING_ROOT, and its secrets in the home of the
+# `staging` user. Both can be moved with environment variables, e.g. by the benchmark, which
+# runs in a sandbox (see staging/benchmark.py)
+STAGING_ROOT = os.environ.get("WONDERBOT_STAGING_ROOT", "/staging")
+STAGING_HOME = os.environ.get("WONDERBOT_STAGING_HOME", "/home/staging")
+
 HIGH_LEVEL_DOMAIN = "wonderbot.gaia.cri.it"
 
-UWSGI_SOCKETS_PATH = "/tmp"
+# Dashboard
+ENVIRONMENTS_PER_PAGE = 50
+LONG_POLL_TIMEOUT = 25  # seconds
+
+UWSGI_SOCKETS_PATH = "%s/run" % (STAGING_ROOT,)
+# Workers of each environment, scaled down to one when there is little traffic. The number of
+# processes is reduced as the environments grow in number, so that all of them fit in the host
+UWSGI_PROCESSES = 4
+UWSGI_THREADS = 2
+UWSGI_MEMORY_FRACTION = 0.6
+UWSGI_PROCESSES_PER_CORE = 2
+# Resident memory of a worker, when none is running to measure it
+UWSGI_WORKER_RSS = 200 * 1024 ** 2
+# Start environments on their first request, and stop them after some time without requests
+UWSGI_ON_DEMAND = True
+UWSGI_IDLE_TIMEOUT = 15 * 60
+UWSGI_STATS_TIMEOUT = 0.2
+# The hot/cold state of the vassals shown on the dashboard is probed this often (seconds)
+UWSGI_STATE_INTERVAL = 30
 
 NGINX_SITES_CONFIGURATION = "/etc/nginx/sites-available"
-NGINX_ROOTS = "/staging"
-
-DB_DUMP_FILENAME = "/staging/dump"
+NGINX_ROOTS = STAGING_ROOT
+
+# Static files of all the environments, stored once per content and hardlinked into each
+# environment, so it must be on the same filesystem as NGINX_ROOTS
+STATIC_STORE_PATH = "%s/static-store" % (STAGING_ROOT,)
+
+# Bare mirrors of the repositories, environments are checked out as worktrees
+GIT_MIRRORS_PATH = "%s/mirrors" % (STAGING_ROOT,)
+# Explicit updates do not fetch again a mirror fetched this recently (seconds)
+GIT_MIRROR_FETCH_MAX_AGE = 60
+
+# Warm pool: environments of the default repository and branch built in advance, so that a new
+# pull request takes one over and only deploys its own changes. They are rebuilt in the
+# background when older than POOL_MAX_AGE (seconds) or when a new dump is ingested.
+POOL_SIZE = 2
+POOL_NAME_PREFIX = "pool-"
+POOL_MAX_AGE = 24 * 60 * 60
+POOL_REFILL_INTERVAL = 15 * 60
+
+# Pushes received within this delay are deployed by a single update
+UPDATE_DEBOUNCE_SECONDS = 30
+# A queued update which has not started after this delay is assumed lost, e.g. with its worker,
+# and queued again. Longer than it may be deferred for (see SCHEDULER_MAX_DEFERRALS)
+UPDATE_PENDING_TIMEOUT = 60 * 60
+
+# Maximum number of provisioning stages run in parallel for an environment
+PIPELINE_POLL_INTERVAL = 1  # seconds, how often cancellation is checked
+PIPELINE_WORKERS = 4
+
+# Number of recent runs of each stage used to compute the statistics
+STAGE_STATISTICS_WINDOW = 200
+
+# Virtualenvs are shared by environments with the same requirements.txt
+VENV_CACHE_PATH = "%s/venvs" % (STAGING_ROOT,)
+VENV_PYTHON = "python3"
+VENV_CACHE_MAX_ENTRIES = 10
+VENV_CACHE_MAX_BYTES = 5 * 1024 ** 3
+
+# Output of the commands, one log file per environment and run, rotated when too large
+LOGS_PATH = "%s/logs" % (STAGING_ROOT,)
+LOG_MAX_BYTES = 20 * 1024 ** 2
+LOG_BACKUPS = 2
+LOG_RUNS_KEPT = 20
+# Recent lines of each environment kept in Redis, and largest chunk returned by the tail endpoint
+LOG_BUFFER_LINES = 200
+LOG_TAIL_BYTES = 64 * 1024
+
+# Production backups are ingested daily into a new generation of the dump (see staging.dumps),
+# DB_DUMP_FILENAME being a link to the current one
+DB_BACKUP_PATH = "/var/lib/postgresql/backup_produzione"
+DB_DUMPS_PATH = "%s/dumps" % (STAGING_ROOT,)
+DB_DUMPS_KEPT = 2
+DB_DUMP_DIRECTORY_FORMAT = True
+DB_DUMP_INGEST_HOUR = 1
+DB_DUMP_FILENAME = "%s/dump" % (STAGING_ROOT,)
+# At most, pg_restore uses as many jobs as there are idle cores
 DB_DUMP_WORKERS = 8
 
-SUDO_BIN = "/usr/bin/sudo"
-
-DB_START_SCRIPT = "/staging/scripts/postgres_start.sh"
-DB_STOP_SCRIPT = "/staging/scripts/postgres_stop.sh"
-
-SKELETON_CONFIGURATION = "/staging/skeleton/"
-
-GITHUB_TOKEN_FILE = "/home/staging/.github_token"
+# Restore the dump once into a template database, and clone it for each environment
+DB_TEMPLATE_ENABLED = True
+DB_TEMPLATE_PREFIX = "staging_template_"
+DB_TEMPLATE_OWNER = "staging_template"
+
+# Snapshots of the environment databases. One can be taken automatically in the background after
+# the migrations, at the cost of a copy of the database, counted against the limits like the others
+DB_SNAPSHOT_OWNER = "staging_snapshot"
+DB_SNAPSHOT_AUTOMATIC = False
+DB_SNAPSHOTS_MAX = 5
+DB_SNAPSHOTS_MAX_BYTES = 20 * 1024 ** 3
+
+# Commands run by the workers are killed after a timeout, in seconds, which depends on their kind
+COMMAND_TIMEOUT = 30 * 60
+COMMAND_TIMEOUTS = {
+    "git": 10 * 60,
+    "pip": 30 * 60,
+    "pg_restore": 2 * 60 * 60,
+}
+COMMAND_KILL_GRACE = 10
+COMMAND_POLL_INTERVAL = 0.5
+# Lines of output reported when a command fails
+COMMAND_ERROR_LINES = 20
+# At most this many commands of each kind at the same time, across all the workers
+COMMAND_LIMITS = {
+    "git": 8,
+    "pip": 4,
+    "pg_restore": 2,
+}
+COMMAND_LIMITS_PATH = "%s/limits" % (STAGING_ROOT,)
+
+SUDO_BIN = os.environ.get("WONDERBOT_SUDO_BIN", "/usr/bin/sudo")
+
+DB_START_SCRIPT = "%s/scripts/postgres_start.sh" % (STAGING_ROOT,)
+DB_STOP_SCRIPT = "%s/scripts/postgres_stop.sh" % (STAGING_ROOT,)
+
+# Restart the whole cluster to drop an environment database, instead of
+# only terminating the connections to that database
+DB_RESTART_ON_DELETE = False
+
+# Nightly vacuuming of environment databases, (start, end) hours in TIME_ZONE
+DB_MAINTENANCE_WINDOW = (2, 6)
+DB_MAINTENANCE_VACUUM_FULL = False
+DB_MAINTENANCE_COST_DELAY = 20  # milliseconds
+
+SKELETON_CONFIGURATION = "%s/skeleton/" % (STAGING_ROOT,)
+
+GITHUB_TOKEN_FILE = "%s/.github_token" % (STAGING_HOME,)
+# Secret of the web hook, deliveries not signed with it are rejected
+GITHUB_WEBHOOK_SECRET_FILE = "%s/.github_webhook_secret" % (STAGING_HOME,)
+GITHUB_API_URL = os.environ.get("WONDERBOT_GITHUB_API_URL", "https://api.github.com")
+GITHUB_STATUS_CONTEXT = "wonderbot-pr"
+GITHUB_STATUS_TIMEOUT = 10  # seconds
+GITHUB_STATUS_RETRIES = 5
+GITHUB_STATUS_BACKOFF = 2  # seconds, doubled at each retry
+# Deliveries not processed after this delay are queued again, and processed ones are kept
+# for some time to recognise redeliveries (seconds)
+WEBHOOK_REQUEUE_AFTER = 60
+# A delivery still being processed after this delay is assumed lost with its worker (seconds),
+# and one failing this many times is given up
+WEBHOOK_CLAIM_TIMEOUT = 10 * 60
+WEBHOOK_ATTEMPTS = 5
+WEBHOOK_DELIVERIES_KEPT = 7 * 24 * 60 * 60
+
+
+REDIS_URL = os.environ.get("WONDERBOT_REDIS_URL", "redis://localhost")
+
+# Cleanup of what environments no longer use, shortly after operations (shared by those finishing
+# within the delay) and periodically (seconds)
+HOUSEKEEPING_DELAY = 60
+HOUSEKEEPING_INTERVAL = 10 * 60
+
+# A single operation at a time on each environment. The lock is extended while the operation runs,
+# and only expires if its worker dies (seconds)
+ENVIRONMENT_LOCK_TIMEOUT = 10 * 60
+ENVIRONMENT_LOCK_EXTEND_INTERVAL = 60
+ENVIRONMENT_LOCK_RETRY_DELAY = 30
+
+# Operations only start while the machine has room for them (see staging.scheduler),
+# with smaller budgets for the less urgent ones. Deletions are always admitted.
+SCHEDULER_MAX_LOAD = {  # 1-minute load average, per core
+    "create": 2.0,
+    "update": 1.5,
+    "background": 1.0,
+}
+SCHEDULER_MAX_IO_PRESSURE = {  # % of time stalled on I/O
+    "create": 60,
+    "update": 40,
+    "background": 20,
+}
+SCHEDULER_MIN_MEMORY = 1024 ** 3
+SCHEDULER_RETRY_DELAY = 60
+# Deferred operations start regardless after this many attempts, so that none waits forever
+SCHEDULER_MAX_DEFERRALS = 30
 
 
 # Celery
-CELERY_TASK_SERIALIZER = 'pickle'
-CELERY_ACCEPT_CONTENT = ['pickle']
+CELERY_TASK_SERIALIZER = 'json'
+CELERY_RESULT_SERIALIZER = 'json'
+CELERY_RESULT_BACKEND = REDIS_URL
+CELERY_ACCEPT_CONTENT = ['json']
+# The crontab schedules below are in the same time zone as the rest (e.g. DB_MAINTENANCE_WINDOW)
+CELERY_TIMEZONE = TIME_ZONE
+CELERY_BEAT_SCHEDULE = {
+    'database-template-check': {
+        'task': 'wonderbot.celery.database_template_check',
+        'schedule': 15 * 60,
+    },
+    'github-events-requeue': {
+        'task': 'wonderbot.celery.github_events_requeue',
+        'schedule': WEBHOOK_REQUEUE_AFTER,
+    },
+    'housekeeping': {
+        'task': 'wonderbot.celery.housekeeping_run',
+        'schedule': HOUSEKEEPING_INTERVAL,
+    },
+    'vassals-probe': {
+        'task': 'wonderbot.celery.vassals_probe',
+        'schedule': UWSGI_STATE_INTERVAL,
+    },
+    'pool-refill': {
+        'task': 'wonderbot.celery.pool_refill',
+        'schedule': POOL_REFILL_INTERVAL,
+    },
+    'dump-ingest': {
+        'task': 'wonderbot.celery.dump_ingest',
+        'schedule': crontab(hour=DB_DUMP_INGEST_HOUR, minute=0),
+    },
+    'database-maintenance': {
+        'task': 'wonderbot.celery.database_maintenance',
+        'schedule': crontab(hour=DB_MAINTENANCE_WINDOW[0], minute=0),
+    },
+}
+# Each queue has its own workers (see cfg/crontab.txt), so that new pull requests, pushes and
+# deletions do not wait for batches of manual operations
+CELERY_TASK_ROUTES = {
+    'wonderbot.celery.environment_create': {'queue': 'create'},
+    'wonderbot.celery.github_event': {'queue': 'webhooks'},
+    'wonderbot.celery.github_events_requeue': {'queue': 'webhooks'},
+    # Frequent and light, like the deliveries, instead of waiting behind long operations
+    'wonderbot.celery.vassals_probe': {'queue': 'webhooks'},
+    'wonderbot.celery.environment_claim': {'queue': 'create'},
+    'wonderbot.celery.environment_update': {'queue': 'update'},
+    'wonderbot.celery.environment_delete': {'queue': 'delete'},
+    'wonderbot.celery.environment_refresh': {'queue': 'background'},
+    'wonderbot.celery.environment_recreate': {'queue': 'background'},
+    'wonderbot.celery.environment_pool_create': {'queue': 'background'},
+    'wonderbot.celery.pool_refill': {'queue': 'background'},
+    'wonderbot.celery.environment_snapshot': {'queue': 'background'},
+    'wonderbot.celery.environment_snapshot_restore': {'queue': 'background'},
+    'wonderbot.celery.environment_snapshot_delete': {'queue': 'background'},
+    'wonderbot.celery.environments_batch': {'queue': 'background'},
+    'wonderbot.celery.environments_batch_finished': {'queue': 'background'},
+    'wonderbot.celery.housekeeping_run': {'queue': 'background'},
+    'wonderbot.celery.database_template_build': {'queue': 'background'},
+    'wonderbot.celery.database_template_check': {'queue': 'background'},
+    'wonderbot.celery.dump_ingest': {'queue': 'background'},
+    'wonderbot.celery.database_maintenance': {'queue': 'maintenance'},
+}
+# Long tasks: do not reserve tasks another idle worker could run
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
@@ -20,6 +20,12 @@ import staging.views as staging
 
 urlpatterns = [
     url(r'^hook/', staging.github_hook),
-    url(r'^', staging.index),
+    url(r'^api/environments/$', staging.environments_api),
+    url(r'^api/environments/wait/$', staging.environments_wait),
+    url(r'^api/environments/(?P<pk>\d+)/log/$', staging.environment_log_api),
+    url(r'^environments/(?P<pk>\d+)/runs/$', staging.environment_runs),
+    url(r'^environments/(?P<pk>\d+)/log/$', staging.environment_log),
+    url(r'^environments/(?P<pk>\d+)/snapshots/$', staging.environment_snapshots),
     url(r'^admin/', admin.site.urls),
+    url(r'^', staging.index),
 ]